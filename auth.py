@@ -1,13 +1,21 @@
+import asyncio
+import hashlib
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_read_db
+from cache import get_cached_user, revoked_tokens, token_cache, user_cache
+from passwords import pwd_context, verify_password, get_password_hash, verify_and_update
+from metrics import PASSWORD_SECONDS, Gauge
 from models import User, UserRole
 import schemas
 
@@ -18,16 +26,64 @@ load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY", "unsafe-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Marks resume tokens so they can't be used as access tokens and vice versa
+RESUME_TOKEN_TYPE = "resume"
+
+# bcrypt runs in its own process pool so it never holds the event loop or the threadpool
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Password operations allowed to wait for a free worker before new ones are turned away
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", "64"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
 # Password utilities
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+_password_pool: Optional[ProcessPoolExecutor] = None
+_password_jobs = 0
+
+def start_password_pool():
+    global _password_pool
+    if _password_pool is None:
+        # spawn keeps the workers from inheriting the server's event loop and sockets
+        _password_pool = ProcessPoolExecutor(
+            max_workers=PASSWORD_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+def shutdown_password_pool():
+    global _password_pool
+    if _password_pool is not None:
+        _password_pool.shutdown(wait=False, cancel_futures=True)
+        _password_pool = None
+
+async def _run_password_job(operation: str, func, *args):
+    global _password_jobs
+    if _password_jobs >= PASSWORD_WORKERS + PASSWORD_QUEUE_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, try again shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    start_password_pool()
+    _password_jobs += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_pool, func, *args)
+    finally:
+        _password_jobs -= 1
+        PASSWORD_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+async def hash_password_async(password: str) -> str:
+    return await _run_password_job("hash", get_password_hash, password)
+
+async def verify_and_update_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return await _run_password_job("verify", verify_and_update, plain_password, hashed_password)
 
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+Gauge(
+    "chat_password_jobs",
+    "bcrypt operations running or queued for the password pool",
+    callback=lambda: _password_jobs
+)
 
 # JWT utilities
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -40,19 +96,12 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str) -> schemas.TokenData:
+def _token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+def _decode_token(token: str) -> dict:
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        role: str = payload.get("role")
-        if username is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        token_data = schemas.TokenData(username=username, role=role)
-        return token_data
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -60,23 +109,128 @@ def verify_token(token: str) -> schemas.TokenData:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+async def verify_token(token: str) -> schemas.TokenData:
+    digest = _token_digest(token)
+    if await revoked_tokens.contains(digest):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has been revoked",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    # Tokens already verified skip the HMAC check and claim parsing until they expire
+    token_data = token_cache.get(digest)
+    if token_data is not None:
+        return token_data
+
+    payload = _decode_token(token)
+    username: str = payload.get("sub")
+    role: str = payload.get("role")
+    if username is None or payload.get("typ") == RESUME_TOKEN_TYPE:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    token_data = schemas.TokenData(username=username, role=role)
+
+    ttl = payload.get("exp", 0) - time.time()
+    if ttl > 0:
+        token_cache.set(digest, token_data, ttl=ttl)
+    return token_data
+
+async def revoke_token(token: str):
+    # Denylisted on every worker until the token would have expired anyway
+    payload = _decode_token(token)
+    digest = _token_digest(token)
+    token_cache.invalidate(digest)
+    ttl = payload.get("exp", 0) - time.time()
+    if ttl > 0:
+        await revoked_tokens.add(digest, ttl)
+
+# Resume tokens: issued to a WebSocket connection so that a reconnect to the same room skips
+# the access token and can take over the connection's presence. They expire with the access
+# token they were issued for and stop working when it is revoked. The user is still looked
+# up (through the user cache), so a changed role or a deleted user applies on resume.
+def resume_session(access_token: str, user_info: dict) -> dict:
+    # What resume tokens of a connection carry besides room and member: the user, and the
+    # digest and expiry of the access token they stand in for. The access token was
+    # verified already, its claims are only read here.
+    claims = jwt.get_unverified_claims(access_token)
+    return {**user_info, "atd": _token_digest(access_token).hex(), "exp": claims.get("exp", 0)}
+
+def create_resume_token(session: dict, room_id: int, member_id: str) -> str:
+    return jwt.encode({
+        "typ": RESUME_TOKEN_TYPE,
+        "sub": session["username"],
+        "uid": session["user_id"],
+        "role": session["role"],
+        "room": room_id,
+        "mid": member_id,
+        "atd": session["atd"],
+        "exp": session["exp"]
+    }, SECRET_KEY, algorithm=ALGORITHM)
+
+async def verify_resume_token(db: AsyncSession, token: str, room_id: int) -> dict:
+    # Returns the session of the connection to resume, with the member_id to take over.
+    # Verified claims are cached next to access tokens, under a key verify_token never uses.
+    digest = b"resume:" + _token_digest(token)
+    claims = token_cache.get(digest)
+    if claims is None:
+        claims = _decode_token(token)
+        if claims.get("typ") != RESUME_TOKEN_TYPE:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials"
+            )
+        ttl = claims.get("exp", 0) - time.time()
+        if ttl > 0:
+            token_cache.set(digest, claims, ttl=ttl)
+
+    if claims["room"] != room_id or await revoked_tokens.contains(bytes.fromhex(claims["atd"])):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials"
+        )
+    user = await get_cached_user(db, claims["sub"])
+    if user is None or user.id != claims["uid"]:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials"
+        )
+    return {
+        "user_id": user.id,
+        "username": user.username,
+        "role": user.role.value,
+        "atd": claims["atd"],
+        "exp": claims["exp"],
+        "member_id": claims["mid"]
+    }
+
 # User authentication
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
-    user = db.query(User).filter(User.username == username).first()
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[User]:
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalars().first()
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = await verify_and_update_async(password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash:
+        # BCRYPT_ROUNDS changed since this hash was made, store it with the current cost
+        user.hashed_password = new_hash
+        await db.commit()
+        user_cache.invalidate(user.username)
     return user
 
 # Dependencies
-def get_current_user(
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_read_db)
 ) -> User:
     token = credentials.credentials
-    token_data = verify_token(token)
-    user = db.query(User).filter(User.username == token_data.username).first()
+    token_data = await verify_token(token)
+    user = await get_cached_user(db, token_data.username)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -106,10 +260,10 @@ def require_user_or_admin(current_user: User = Depends(get_current_user)) -> Use
     return current_user
 
 # WebSocket token verification
-def verify_websocket_token(token: Optional[str] = Query(None)) -> schemas.TokenData:
+async def verify_websocket_token(token: Optional[str] = Query(None)) -> schemas.TokenData:
     if not token:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token required for WebSocket connection"
         )
-    return verify_token(token)
+    return await verify_token(token)
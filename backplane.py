@@ -0,0 +1,611 @@
+import abc
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# "memory://" keeps everything in-process, "redis://host:port/db" shares rooms across workers
+BACKPLANE_URL = os.getenv("BACKPLANE_URL", "memory://")
+
+# Unique id of this worker process
+NODE_ID = uuid.uuid4().hex
+
+# (room_id, kind, frame, event_id, seq)
+MessageHandler = Callable[[int, str, str, int, int], Awaitable[None]]
+# Highest seq already used in a room, asked for when its counter has to be created
+SequenceFloor = Callable[[int], Awaitable[int]]
+
+def sequenced_frame(seq: int, frame: str) -> str:
+    # Puts the seq first in a JSON object frame without decoding it
+    return '{"seq":%d,%s' % (seq, frame[1:])
+
+# Interface for delivering room events and presence across processes
+class Backplane(abc.ABC):
+    def __init__(self):
+        self._handler: Optional[MessageHandler] = None
+
+    def set_handler(self, handler: MessageHandler):
+        # Called for every event published to a room this process is subscribed to
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def subscribe(self, room_id: int):
+        pass
+
+    async def unsubscribe(self, room_id: int):
+        pass
+
+    @abc.abstractmethod
+    async def publish(
+        self,
+        room_id: int,
+        kind: str,
+        frame: str,
+        event_id: int = 0,
+        seq_floor: Optional[SequenceFloor] = None
+    ) -> int:
+        # With a seq_floor the event takes the room's next sequence number, which is added
+        # to the frame and returned. seq_floor is only awaited when the room has no counter
+        # (first event since a restart), which then continues after the floor. Events reach
+        # every subscriber in sequence order. Without one the event is unsequenced and 0 is returned.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_sequence(self, room_id: int) -> Optional[int]:
+        # Seq of the room's last sequenced event, None before its first since a restart
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def lease_worker_id(self, count: int, worker_id: Optional[int] = None) -> int:
+        # A message id worker number below count that no other live worker holds, kept
+        # until stop(). A given worker_id is checked instead; raises RuntimeError when taken.
+        raise NotImplementedError
+
+    # Presence is tracked per connection (member) and counted per user. add/remove return
+    # True when the user's first connection arrived or last one left, across all workers.
+    @abc.abstractmethod
+    async def add_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def remove_presence(self, room_id: int, member_id: str, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def commit_presence(self, room_id: int, user_ids: Iterable[int]) -> Tuple[int, Dict[int, bool]]:
+        # Bumps the room's presence version and returns it with whether each user is present now
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_presence_version(self, room_id: int) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get_presence(self, room_id: int) -> Tuple[int, List[dict]]:
+        # (version, one entry per present user)
+        raise NotImplementedError
+
+    # A dropped connection's presence is kept for a grace period, so a quick reconnect shows
+    # no leave and join. Departures are shared by all workers: any of them may reclaim one
+    # for a resumed connection or remove it once the deadline (a Unix time) has passed.
+    # Presence of a worker that died without stop() is turned into departures due at once.
+    @abc.abstractmethod
+    async def defer_presence_removal(self, room_id: int, member_id: str, user_info: dict, deadline: float):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def reclaim_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        # True when the member was waiting to leave and now belongs to the caller
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def claim_departures(self, now: float) -> List[Tuple[int, str, dict]]:
+        # (room_id, member_id, user_info) of departures past their deadline, each handed to
+        # exactly one caller, which then removes the presence
+        raise NotImplementedError
+
+# Single process backplane, events are delivered straight back to the local manager
+class InMemoryBackplane(Backplane):
+    def __init__(self):
+        super().__init__()
+        self.presence: Dict[int, Dict[str, dict]] = {}
+        self.user_counts: Dict[int, Dict[int, int]] = {}
+        self.versions: Dict[int, int] = {}
+        self.sequences: Dict[int, int] = {}
+        self.departures: Dict[str, Tuple[int, dict, float]] = {}
+
+    async def publish(
+        self,
+        room_id: int,
+        kind: str,
+        frame: str,
+        event_id: int = 0,
+        seq_floor: Optional[SequenceFloor] = None
+    ) -> int:
+        seq = 0
+        if seq_floor is not None:
+            if room_id not in self.sequences:
+                floor = await seq_floor(room_id)
+                self.sequences.setdefault(room_id, floor)
+            seq = self.sequences[room_id] = self.sequences[room_id] + 1
+            frame = sequenced_frame(seq, frame)
+        if self._handler:
+            await self._handler(room_id, kind, frame, event_id, seq)
+        return seq
+
+    async def get_sequence(self, room_id: int) -> Optional[int]:
+        return self.sequences.get(room_id)
+
+    async def lease_worker_id(self, count: int, worker_id: Optional[int] = None) -> int:
+        # The only worker there is
+        return 0 if worker_id is None else worker_id
+
+    async def add_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        self.presence.setdefault(room_id, {})[member_id] = user_info
+        counts = self.user_counts.setdefault(room_id, {})
+        counts[user_info["user_id"]] = counts.get(user_info["user_id"], 0) + 1
+        return counts[user_info["user_id"]] == 1
+
+    async def remove_presence(self, room_id: int, member_id: str, user_id: int) -> bool:
+        members = self.presence.get(room_id)
+        if members is None or members.pop(member_id, None) is None:
+            return False
+        if not members:
+            del self.presence[room_id]
+
+        counts = self.user_counts[room_id]
+        counts[user_id] -= 1
+        if counts[user_id] > 0:
+            return False
+        del counts[user_id]
+        if not counts:
+            del self.user_counts[room_id]
+        return True
+
+    async def commit_presence(self, room_id: int, user_ids: Iterable[int]) -> Tuple[int, Dict[int, bool]]:
+        version = self.versions[room_id] = self.versions.get(room_id, 0) + 1
+        counts = self.user_counts.get(room_id, {})
+        return version, {user_id: user_id in counts for user_id in user_ids}
+
+    async def get_presence_version(self, room_id: int) -> int:
+        return self.versions.get(room_id, 0)
+
+    async def get_presence(self, room_id: int) -> Tuple[int, List[dict]]:
+        users = {info["user_id"]: info for info in self.presence.get(room_id, {}).values()}
+        return self.versions.get(room_id, 0), list(users.values())
+
+    async def defer_presence_removal(self, room_id: int, member_id: str, user_info: dict, deadline: float):
+        self.departures[member_id] = (room_id, user_info, deadline)
+
+    async def reclaim_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        return self.departures.pop(member_id, None) is not None
+
+    async def claim_departures(self, now: float) -> List[Tuple[int, str, dict]]:
+        expired = [member_id for member_id, (_, _, deadline) in self.departures.items() if deadline <= now]
+        claimed = []
+        for member_id in expired:
+            room_id, user_info, _ = self.departures.pop(member_id)
+            claimed.append((room_id, member_id, user_info))
+        return claimed
+
+# Redis pub/sub backplane, one channel per room plus presence keys per room:
+# a member hash (connection -> user), a per-user connection count hash and a version counter,
+# and an event sequence counter per room. Pending departures are a sorted set of members by
+# deadline with their room and user in a hash. Each worker keeps a heartbeat key with a TTL
+# alive and lists the members it owns in a hash of its own, so the others can turn the
+# presence of a crashed worker into departures. Message id worker numbers are leased as keys
+# holding the owner's NODE_ID with the same TTL, renewed along with the heartbeat.
+class RedisBackplane(Backplane):
+    CHANNEL_PREFIX = "chat:room:"
+    SEQUENCE_PREFIX = "chat:seq:"
+    PRESENCE_PREFIX = "chat:presence:"
+    PRESENCE_COUNTS_PREFIX = "chat:presence_counts:"
+    PRESENCE_VERSION_PREFIX = "chat:presence_version:"
+    DEPARTURES_KEY = "chat:departures"
+    DEPARTURE_INFO_KEY = "chat:departure_info"
+    WORKER_ID_PREFIX = "chat:worker_id:"
+    NODE_PREFIX = "chat:node:"
+    NODE_MEMBERS_PREFIX = "chat:node_members:"
+    NODES_KEY = "chat:nodes"
+    # Seconds a worker's heartbeat and worker id lease outlive its last renewal, e.g. after a crash
+    NODE_TTL = 30
+
+    # KEYS: members, counts, node members, nodes. ARGV: member_id, user_id, user json, node id,
+    # departure info json. Returns the user's connection count.
+    ADD_PRESENCE_SCRIPT = """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[5])
+redis.call('SADD', KEYS[4], ARGV[4])
+return redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+"""
+    # KEYS: members, counts, node members. ARGV: member_id, user_id. Returns the remaining
+    # count, -1 if unknown.
+    REMOVE_PRESENCE_SCRIPT = """
+redis.call('HDEL', KEYS[3], ARGV[1])
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return -1
+end
+local count = redis.call('HINCRBY', KEYS[2], ARGV[2], -1)
+if count <= 0 then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+end
+return count
+"""
+    # KEYS: version, counts. ARGV: user ids. Returns the new version followed by each user's count.
+    COMMIT_PRESENCE_SCRIPT = """
+local result = {redis.call('INCR', KEYS[1])}
+for i, user_id in ipairs(ARGV) do
+    result[i + 1] = tonumber(redis.call('HGET', KEYS[2], user_id) or '0')
+end
+return result
+"""
+
+    # KEYS: sequence, channel. ARGV: floor, kind, event_id, frame. Returns the event's seq,
+    # or 0 without publishing when the counter doesn't exist and no floor ('') was given.
+    # Numbering and publishing in one script keeps channel order equal to seq order.
+    PUBLISH_SEQUENCED_SCRIPT = """
+local seq
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    seq = redis.call('INCR', KEYS[1])
+elseif ARGV[1] == '' then
+    return 0
+else
+    seq = tonumber(ARGV[1]) + 1
+    redis.call('SET', KEYS[1], seq)
+end
+local frame = '{"seq":' .. string.format('%d', seq) .. ',' .. string.sub(ARGV[4], 2)
+redis.call('PUBLISH', KEYS[2], ARGV[2] .. '\\n' .. ARGV[3] .. '\\n' .. string.format('%d', seq) .. '\\n' .. frame)
+return seq
+"""
+    # KEYS: departures, info. ARGV: now, limit. Returns member, info pairs past their deadline.
+    CLAIM_DEPARTURES_SCRIPT = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local result = {}
+for _, member in ipairs(members) do
+    redis.call('ZREM', KEYS[1], member)
+    result[#result + 1] = member
+    result[#result + 1] = redis.call('HGET', KEYS[2], member) or ''
+    redis.call('HDEL', KEYS[2], member)
+end
+return result
+"""
+    # KEYS: departures, info, node members, nodes. ARGV: member_id, node id, departure info json.
+    # Returns 1 when the member was waiting to leave and now belongs to the node.
+    RECLAIM_PRESENCE_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+redis.call('SADD', KEYS[4], ARGV[2])
+return 1
+"""
+    # KEYS: heartbeat, node members, departures, info, nodes. ARGV: node id, now. Unless the
+    # node's heartbeat is alive, makes its members departures due now. Returns how many.
+    REAP_NODE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local entries = redis.call('HGETALL', KEYS[2])
+for i = 1, #entries, 2 do
+    redis.call('HSET', KEYS[4], entries[i], entries[i + 1])
+    redis.call('ZADD', KEYS[3], ARGV[2], entries[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('SREM', KEYS[5], ARGV[1])
+return #entries / 2
+"""
+    # KEYS: lease. ARGV: node id, ttl. Extends the lease if this node holds it, takes it
+    # back if it lapsed. Returns 1 when the node holds it afterwards.
+    RENEW_LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+    # KEYS: lease. ARGV: node id. Deletes the lease if this node holds it.
+    RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+    # Departures claimed per round trip
+    CLAIM_BATCH_SIZE = 500
+
+    def __init__(self, url: str):
+        super().__init__()
+        self.url = url
+        self._redis = None
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._keepalive: Optional[asyncio.Task] = None
+        self._worker_id: Optional[int] = None
+        # Presence members owned by this process, removed again on shutdown
+        self._members: Dict[str, Tuple[int, int]] = {}
+        self._scripts = {}
+
+    async def start(self):
+        if self._redis is None:
+            # Imported lazily so the in-memory backplane works without redis installed
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.url, decode_responses=True)
+            self._pubsub = self._redis.pubsub()
+            self._scripts = {
+                "add": self._redis.register_script(self.ADD_PRESENCE_SCRIPT),
+                "remove": self._redis.register_script(self.REMOVE_PRESENCE_SCRIPT),
+                "commit": self._redis.register_script(self.COMMIT_PRESENCE_SCRIPT),
+                "publish": self._redis.register_script(self.PUBLISH_SEQUENCED_SCRIPT),
+                "claim": self._redis.register_script(self.CLAIM_DEPARTURES_SCRIPT),
+                "reclaim": self._redis.register_script(self.RECLAIM_PRESENCE_SCRIPT),
+                "reap": self._redis.register_script(self.REAP_NODE_SCRIPT),
+                "renew": self._redis.register_script(self.RENEW_LEASE_SCRIPT),
+                "release": self._redis.register_script(self.RELEASE_LEASE_SCRIPT)
+            }
+            # Alive before this worker owns any presence
+            await self._redis.set(self._node_key(NODE_ID), 1, ex=self.NODE_TTL)
+            self._keepalive = asyncio.create_task(self._keep_alive())
+
+    async def stop(self):
+        if self._redis is None:
+            return
+
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+
+        if self._keepalive:
+            self._keepalive.cancel()
+            self._keepalive = None
+
+        if self._worker_id is not None:
+            await self._scripts["release"](keys=[self._worker_id_key(self._worker_id)], args=[NODE_ID])
+            self._worker_id = None
+
+        # Drop presence entries of this process so other workers don't see ghosts. Deferred
+        # departures are no longer ours, whichever worker is alive removes them in time.
+        for member_id, (room_id, user_id) in list(self._members.items()):
+            await self._scripts["remove"](
+                keys=[self._presence_key(room_id), self._counts_key(room_id), self._node_members_key(NODE_ID)],
+                args=[member_id, user_id]
+            )
+        self._members.clear()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(self._node_members_key(NODE_ID), self._node_key(NODE_ID))
+            pipe.srem(self.NODES_KEY, NODE_ID)
+            await pipe.execute()
+
+        await self._pubsub.close()
+        await self._redis.close()
+        self._redis = None
+        self._pubsub = None
+
+    async def subscribe(self, room_id: int):
+        await self.start()
+        await self._pubsub.subscribe(self._channel(room_id))
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def unsubscribe(self, room_id: int):
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self._channel(room_id))
+
+    async def publish(
+        self,
+        room_id: int,
+        kind: str,
+        frame: str,
+        event_id: int = 0,
+        seq_floor: Optional[SequenceFloor] = None
+    ) -> int:
+        await self.start()
+        if seq_floor is None:
+            await self._redis.publish(self._channel(room_id), f"{kind}\n{event_id}\n0\n{frame}")
+            return 0
+        keys = [self._sequence_key(room_id), self._channel(room_id)]
+        seq = int(await self._scripts["publish"](keys=keys, args=["", kind, event_id, frame]))
+        if not seq:
+            # The counter is gone (new room or Redis restarted), continue after the log
+            floor = await seq_floor(room_id)
+            seq = int(await self._scripts["publish"](keys=keys, args=[floor, kind, event_id, frame]))
+        return seq
+
+    async def get_sequence(self, room_id: int) -> Optional[int]:
+        await self.start()
+        seq = await self._redis.get(self._sequence_key(room_id))
+        return None if seq is None else int(seq)
+
+    async def lease_worker_id(self, count: int, worker_id: Optional[int] = None) -> int:
+        await self.start()
+        if self._worker_id is not None:
+            return self._worker_id
+        candidates = range(count) if worker_id is None else [worker_id]
+        for candidate in candidates:
+            if await self._redis.set(self._worker_id_key(candidate), NODE_ID, nx=True, ex=self.NODE_TTL):
+                self._worker_id = candidate
+                return candidate
+        if worker_id is None:
+            raise RuntimeError(f"All {count} message id worker numbers are leased by other workers")
+        raise RuntimeError(f"Message id worker number {worker_id} is used by another worker")
+
+    async def add_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        await self.start()
+        self._members[member_id] = (room_id, user_info["user_id"])
+        count = await self._scripts["add"](
+            keys=[
+                self._presence_key(room_id), self._counts_key(room_id),
+                self._node_members_key(NODE_ID), self.NODES_KEY
+            ],
+            args=[
+                member_id, user_info["user_id"], json.dumps(user_info), NODE_ID,
+                json.dumps({"room_id": room_id, **user_info})
+            ]
+        )
+        return int(count) == 1
+
+    async def remove_presence(self, room_id: int, member_id: str, user_id: int) -> bool:
+        await self.start()
+        self._members.pop(member_id, None)
+        count = await self._scripts["remove"](
+            keys=[self._presence_key(room_id), self._counts_key(room_id), self._node_members_key(NODE_ID)],
+            args=[member_id, user_id]
+        )
+        return int(count) == 0
+
+    async def commit_presence(self, room_id: int, user_ids: Iterable[int]) -> Tuple[int, Dict[int, bool]]:
+        await self.start()
+        user_ids = list(user_ids)
+        result = await self._scripts["commit"](
+            keys=[self._version_key(room_id), self._counts_key(room_id)],
+            args=user_ids
+        )
+        return int(result[0]), {user_id: int(count) > 0 for user_id, count in zip(user_ids, result[1:])}
+
+    async def get_presence_version(self, room_id: int) -> int:
+        await self.start()
+        return int(await self._redis.get(self._version_key(room_id)) or 0)
+
+    async def get_presence(self, room_id: int) -> Tuple[int, List[dict]]:
+        await self.start()
+        # Read the version and the members atomically
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.get(self._version_key(room_id))
+            pipe.hvals(self._presence_key(room_id))
+            version, values = await pipe.execute()
+        users = {}
+        for value in values:
+            info = json.loads(value)
+            users[info["user_id"]] = info
+        return int(version or 0), list(users.values())
+
+    async def defer_presence_removal(self, room_id: int, member_id: str, user_info: dict, deadline: float):
+        await self.start()
+        self._members.pop(member_id, None)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.DEPARTURE_INFO_KEY, member_id, json.dumps({"room_id": room_id, **user_info}))
+            pipe.zadd(self.DEPARTURES_KEY, {member_id: deadline})
+            pipe.hdel(self._node_members_key(NODE_ID), member_id)
+            await pipe.execute()
+
+    async def reclaim_presence(self, room_id: int, member_id: str, user_info: dict) -> bool:
+        await self.start()
+        reclaimed = await self._scripts["reclaim"](
+            keys=[self.DEPARTURES_KEY, self.DEPARTURE_INFO_KEY, self._node_members_key(NODE_ID), self.NODES_KEY],
+            args=[member_id, NODE_ID, json.dumps({"room_id": room_id, **user_info})]
+        )
+        if not reclaimed:
+            return False
+        self._members[member_id] = (room_id, user_info["user_id"])
+        return True
+
+    async def claim_departures(self, now: float) -> List[Tuple[int, str, dict]]:
+        await self.start()
+        result = await self._scripts["claim"](
+            keys=[self.DEPARTURES_KEY, self.DEPARTURE_INFO_KEY],
+            args=[now, self.CLAIM_BATCH_SIZE]
+        )
+        claimed = []
+        for member_id, value in zip(result[::2], result[1::2]):
+            if value:
+                info = json.loads(value)
+                claimed.append((info.pop("room_id"), member_id, info))
+        return claimed
+
+    def _channel(self, room_id: int) -> str:
+        return f"{self.CHANNEL_PREFIX}{room_id}"
+
+    def _presence_key(self, room_id: int) -> str:
+        return f"{self.PRESENCE_PREFIX}{room_id}"
+
+    def _counts_key(self, room_id: int) -> str:
+        return f"{self.PRESENCE_COUNTS_PREFIX}{room_id}"
+
+    def _version_key(self, room_id: int) -> str:
+        return f"{self.PRESENCE_VERSION_PREFIX}{room_id}"
+
+    def _sequence_key(self, room_id: int) -> str:
+        return f"{self.SEQUENCE_PREFIX}{room_id}"
+
+    def _worker_id_key(self, worker_id: int) -> str:
+        return f"{self.WORKER_ID_PREFIX}{worker_id}"
+
+    def _node_key(self, node_id: str) -> str:
+        return f"{self.NODE_PREFIX}{node_id}"
+
+    def _node_members_key(self, node_id: str) -> str:
+        return f"{self.NODE_MEMBERS_PREFIX}{node_id}"
+
+    async def reap_dead_nodes(self, now: float) -> int:
+        # Makes the members of workers whose heartbeat expired departures due at now, returns
+        # how many. claim_departures then hands them out like any other departure.
+        reaped = 0
+        for node_id in await self._redis.smembers(self.NODES_KEY):
+            if node_id == NODE_ID:
+                continue
+            reaped += int(await self._scripts["reap"](
+                keys=[
+                    self._node_key(node_id), self._node_members_key(node_id),
+                    self.DEPARTURES_KEY, self.DEPARTURE_INFO_KEY, self.NODES_KEY
+                ],
+                args=[node_id, now]
+            ))
+        return reaped
+
+    async def _keep_alive(self):
+        # Renews the heartbeat and the worker id lease, and reaps workers that stopped renewing
+        while True:
+            await asyncio.sleep(self.NODE_TTL / 3)
+            try:
+                alive = await self._redis.set(self._node_key(NODE_ID), 1, ex=self.NODE_TTL, get=True)
+                if alive is None:
+                    # Stalled past the TTL, other workers may have removed our presence
+                    print(f"Backplane heartbeat of {NODE_ID} had expired")
+                if self._worker_id is not None and not await self._scripts["renew"](
+                    keys=[self._worker_id_key(self._worker_id)], args=[NODE_ID, self.NODE_TTL]
+                ):
+                    # Another worker took it while we couldn't renew, ids may collide
+                    print(f"Lost message id worker number {self._worker_id} to another worker")
+                await self.reap_dead_nodes(time.time())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Backplane error: {e}")
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message["type"] != "message" or not self._handler:
+                    continue
+
+                room_id = int(message["channel"][len(self.CHANNEL_PREFIX):])
+                kind, event_id, seq, frame = message["data"].split("\n", 3)
+                await self._handler(room_id, kind, frame, int(event_id), int(seq))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Backplane error: {e}")
+                await asyncio.sleep(1.0)
+
+def create_backplane(url: str = BACKPLANE_URL) -> Backplane:
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisBackplane(url)
+    return InMemoryBackplane()
@@ -0,0 +1,543 @@
+"""
+Load-testing and benchmark harness for the chat application.
+
+Starts the app with uvicorn against a throwaway SQLite database (or the
+DATABASE_URL you pass), connects simulated WebSocket clients across several
+rooms, drives a fixed message rate and measures end-to-end delivery latency,
+join latency and REST throughput. Results are written as JSON.
+
+Usage:
+    python benchmark.py --clients 200 --rooms 10 --rate 2 --duration 15 --output bench.json
+    python benchmark.py --url http://localhost:8000   # against a running server
+    python benchmark.py --idle-sockets 10000 --db-pool-size 5 --database-url postgresql://...
+                                                      # idle sockets hold no DB connections
+    python benchmark.py --memory-connections 100000   # ConnectionManager bytes per connection
+    python benchmark.py --memory-connections 10000 --memory-subscriptions 15 --rooms 100
+                                                      # multiplexed: 15 rooms per connection
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import http.client
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import msgpack
+import websockets
+
+BENCH_PREFIX = "bench"
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": round(ordered[-1], 3)
+    }
+
+# Minimal keep-alive HTTP client, one per thread
+class HttpClient:
+    def __init__(self, base_url: str):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def request(self, method: str, path: str, body: Optional[dict] = None, token: Optional[str] = None):
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        payload = json.dumps(body) if body is not None else None
+        try:
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # Reconnect once on a dropped keep-alive connection
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.conn.request(method, path, body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        return response.status, (json.loads(data) if data else None)
+
+def start_server(args, workdir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env.pop("ASYNC_DATABASE_URL", None)
+    env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # Load generators come from one IP and push far past per-user limits
+    env["RATE_LIMIT_ENABLED"] = "true" if args.rate_limits else "false"
+    if args.db_pool_size:
+        # A hard cap, requests past it wait for a connection instead of overflowing
+        env["DB_POOL_SIZE"] = str(args.db_pool_size)
+        env["DB_MAX_OVERFLOW"] = "0"
+    command = [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(args.port),
+        "--workers", str(args.workers), "--log-level", "warning"
+    ]
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+def wait_for_server(base_url: str, timeout: float = 30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            status, _ = HttpClient(base_url).request("GET", "/health")
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not become healthy")
+
+def setup_fixtures(base_url: str, args) -> Dict[str, object]:
+    client = HttpClient(base_url)
+    run_id = str(int(time.time()))
+    users = []
+    for i in range(args.users + 1):
+        username = f"{BENCH_PREFIX}{run_id}u{i}"
+        role = "admin" if i == 0 else "user"
+        client.request("POST", "/auth/signup", {
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "benchpass",
+            "role": role
+        })
+        status, body = client.request("POST", "/auth/login", {"username": username, "password": "benchpass"})
+        if status != 200:
+            raise RuntimeError(f"Login failed for {username}: {status} {body}")
+        users.append({"username": username, "token": body["access_token"]})
+
+    admin, members = users[0], users[1:]
+    rooms = []
+    for i in range(args.rooms):
+        status, body = client.request("POST", "/rooms/", {"name": f"{BENCH_PREFIX}{run_id}r{i}"}, admin["token"])
+        if status != 201:
+            raise RuntimeError(f"Room creation failed: {status} {body}")
+        rooms.append(body["id"])
+    return {"admin": admin, "users": members, "rooms": rooms}
+
+class SimulatedClient:
+    def __init__(self, index: int, ws_url: str, token: str, room_id: int, wire_format: str = "json"):
+        self.index = index
+        self.url = f"{ws_url}/ws/{room_id}?token={token}"
+        self.room_id = room_id
+        self.binary = wire_format == "msgpack"
+        self.socket = None
+        self.sent = 0
+        self.received = 0
+        self.latencies: List[float] = []
+        self.join_latency: Optional[float] = None
+        self._joined = asyncio.Event()
+
+    async def connect(self):
+        started = time.perf_counter()
+        subprotocols = ["chat.msgpack"] if self.binary else None
+        self.socket = await websockets.connect(self.url, max_queue=None, subprotocols=subprotocols)
+        self._reader = asyncio.create_task(self._read())
+        await self._joined.wait()
+        self.join_latency = (time.perf_counter() - started) * 1000
+
+    async def _read(self):
+        try:
+            async for raw in self.socket:
+                data = msgpack.unpackb(raw) if isinstance(raw, bytes) else json.loads(raw)
+                kind = data.get("type")
+                if kind == "history":
+                    self._joined.set()
+                elif kind == "message":
+                    self._joined.set()
+                    content = data.get("content", "")
+                    if content.startswith(BENCH_PREFIX + " "):
+                        sent_at = int(content.split(" ")[3])
+                        self.latencies.append((time.perf_counter_ns() - sent_at) / 1e6)
+                        self.received += 1
+                elif kind == "ping":
+                    await self.socket.send(self._encode({"type": "pong"}))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._joined.set()
+
+    async def send_loop(self, rate: float, duration: float):
+        interval = 1.0 / rate
+        deadline = time.perf_counter() + duration
+        # Spread clients out so they don't all send on the same tick
+        await asyncio.sleep(interval * ((self.index * 0.618) % 1.0))
+        while time.perf_counter() < deadline:
+            content = f"{BENCH_PREFIX} {self.index} {self.sent} {time.perf_counter_ns()}"
+            await self.socket.send(self._encode({"content": content}))
+            self.sent += 1
+            await asyncio.sleep(interval)
+
+    def _encode(self, payload: dict):
+        return msgpack.packb(payload) if self.binary else json.dumps(payload)
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+            self._reader.cancel()
+
+async def run_websocket_benchmark(base_url: str, fixtures: dict, args) -> dict:
+    ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://")
+    users, rooms = fixtures["users"], fixtures["rooms"]
+    clients = [
+        SimulatedClient(i, ws_url, users[i % len(users)]["token"], rooms[i % len(rooms)], args.wire_format)
+        for i in range(args.clients)
+    ]
+
+    # Connect in waves so the join latency reflects the server, not the client's own burst
+    for start in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*(client.connect() for client in clients[start:start + args.connect_batch]))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client.send_loop(args.rate, args.duration) for client in clients))
+    send_elapsed = time.perf_counter() - started
+    # Let in-flight deliveries arrive
+    await asyncio.sleep(args.drain)
+
+    await asyncio.gather(*(client.close() for client in clients))
+
+    sent = sum(client.sent for client in clients)
+    room_sizes: Dict[int, int] = {}
+    for client in clients:
+        room_sizes[client.room_id] = room_sizes.get(client.room_id, 0) + 1
+    expected = sum(client.sent * room_sizes[client.room_id] for client in clients)
+    delivered = sum(client.received for client in clients)
+    latencies = [latency for client in clients for latency in client.latencies]
+    joins = [client.join_latency for client in clients if client.join_latency is not None]
+
+    return {
+        "clients": len(clients),
+        "rooms": len(rooms),
+        "messages_sent": sent,
+        "deliveries_expected": expected,
+        "deliveries": delivered,
+        "delivery_ratio": round(delivered / expected, 4) if expected else None,
+        "send_throughput_msgs_per_s": round(sent / send_elapsed, 1),
+        "delivery_throughput_msgs_per_s": round(delivered / send_elapsed, 1),
+        "delivery_latency_ms": percentiles(latencies),
+        "join_latency_ms": percentiles(joins)
+    }
+
+async def run_idle_benchmark(base_url: str, fixtures: dict, args) -> dict:
+    # Opens --idle-sockets connections that stay silent after joining, then checks that they
+    # hold no database connections: nothing is checked out of the pools and REST requests,
+    # which each need a pooled connection, are still served.
+    ws_url = base_url.replace("http://", "ws://").replace("https://", "wss://")
+    users, rooms = fixtures["users"], fixtures["rooms"]
+    clients = [
+        SimulatedClient(i, ws_url, users[i % len(users)]["token"], rooms[i % len(rooms)], args.wire_format)
+        for i in range(args.idle_sockets)
+    ]
+
+    started = time.perf_counter()
+    for start in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*(client.connect() for client in clients[start:start + args.connect_batch]))
+    connect_elapsed = time.perf_counter() - started
+    # Let the last joins finish on the server
+    await asyncio.sleep(1.0)
+
+    # Blocking HTTP runs in a thread so the sockets keep answering pings
+    _, health = await asyncio.to_thread(HttpClient(base_url).request, "GET", "/health")
+    pools = health.get("database_pools", {})
+    rest = await asyncio.to_thread(
+        run_rest_benchmark,
+        base_url,
+        "GET /rooms/{room_id}/messages",
+        lambda client: client.request(
+            "GET", f"/rooms/{rooms[0]}/messages?limit=50", token=users[0]["token"]
+        ),
+        args.rest_concurrency,
+        args.rest_duration
+    )
+    open_sockets = sum(1 for client in clients if client.socket is not None and client.socket.open)
+
+    await asyncio.gather(*(client.close() for client in clients))
+
+    return {
+        "idle_sockets": len(clients),
+        "open_after_rest": open_sockets,
+        "connect_seconds": round(connect_elapsed, 2),
+        "join_latency_ms": percentiles([c.join_latency for c in clients if c.join_latency is not None]),
+        "db_pools": pools,
+        "db_connections_checked_out": sum(stats.get("checked_out", 0) for stats in pools.values()),
+        "rest_while_idle": rest
+    }
+
+class IdleWebSocket:
+    # Stand-in for a server-side socket in the memory benchmark, accepts and discards frames
+    __slots__ = ()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+async def run_memory_benchmark(args) -> dict:
+    # In-process: connects idle sockets to a ConnectionManager with the in-memory backplane and
+    # counts what the manager allocates for them. The sockets themselves are not included.
+    # With --memory-subscriptions each socket is multiplexed over that many rooms.
+    os.environ["WS_HEARTBEAT_INTERVAL"] = "0"
+    from websocket_manager import ConnectionManager
+
+    manager = ConnectionManager()
+    sockets = [IdleWebSocket() for _ in range(args.memory_connections)]
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for i, websocket in enumerate(sockets):
+            # Fresh strings per connection, like decoded tokens would produce
+            user = i % args.users
+            await manager.accept(websocket, {"user_id": user, "username": f"{BENCH_PREFIX}_user{user}"})
+            for j in range(args.memory_subscriptions):
+                room_id = (i + j) % args.rooms
+                await manager.subscribe(websocket, room_id)
+                manager.release(websocket, room_id)
+    connect_elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.5)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    # One event to the first room, then let the writers drain it
+    recipients = manager.get_room_connections_count(0)
+    started = time.perf_counter()
+    await manager._deliver_local(0, "message", json.dumps({"type": "message", "content": BENCH_PREFIX}))
+    fanout_elapsed = time.perf_counter() - started
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        await manager.stop()
+
+    return {
+        "connections": len(sockets),
+        "subscriptions": len(sockets) * args.memory_subscriptions,
+        "rooms": args.rooms,
+        "users": args.users,
+        "bytes_per_connection": round(used / len(sockets), 1),
+        "bytes_per_subscription": round(used / (len(sockets) * args.memory_subscriptions), 1),
+        "total_mb": round(used / 1e6, 1),
+        "connect_us_per_connection": round(connect_elapsed / len(sockets) * 1e6, 2),
+        "fanout_ms": round(fanout_elapsed * 1000, 2),
+        "fanout_recipients": recipients
+    }
+
+def run_rest_benchmark(base_url: str, name: str, request, concurrency: int, duration: float) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        nonlocal errors
+        client = HttpClient(base_url)
+        local, local_errors = [], 0
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                status, _ = request(client)
+                if status >= 400:
+                    local_errors += 1
+            except OSError:
+                local_errors += 1
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+            errors += local_errors
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "endpoint": name,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "qps": round(len(latencies) / elapsed, 1),
+        "latency_ms": percentiles(latencies)
+    }
+
+def run_rest_benchmarks(base_url: str, fixtures: dict, args) -> List[dict]:
+    user = fixtures["users"][0]
+    room_id = fixtures["rooms"][0]
+    return [
+        run_rest_benchmark(
+            base_url,
+            "GET /rooms/{room_id}/messages",
+            lambda client: client.request("GET", f"/rooms/{room_id}/messages?limit=50", token=user["token"]),
+            args.rest_concurrency,
+            args.rest_duration
+        ),
+        run_rest_benchmark(
+            base_url,
+            "POST /auth/login",
+            lambda client: client.request("POST", "/auth/login", {"username": user["username"], "password": "benchpass"}),
+            args.rest_concurrency,
+            args.rest_duration
+        ),
+    ]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark WebSocket fan-out and REST endpoints")
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one")
+    parser.add_argument("--database-url", help="DATABASE_URL for the spawned server (default: temporary SQLite)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the spawned server")
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="BCRYPT_ROUNDS for the spawned server")
+    parser.add_argument("--clients", type=int, default=100, help="Simulated WebSocket clients")
+    parser.add_argument("--rooms", type=int, default=5, help="Rooms the clients are spread across")
+    parser.add_argument("--users", type=int, default=20, help="Distinct user accounts shared by the clients")
+    parser.add_argument("--rate", type=float, default=1.0, help="Messages per second sent by each client")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of message traffic")
+    parser.add_argument("--drain", type=float, default=2.0, help="Seconds to wait for in-flight deliveries")
+    parser.add_argument(
+        "--wire-format",
+        choices=["json", "msgpack"],
+        default="json",
+        help="WebSocket frame format used by the simulated clients"
+    )
+    parser.add_argument("--rate-limits", action="store_true", help="Keep rate limits on in the spawned server")
+    parser.add_argument("--connect-batch", type=int, default=50, help="Clients connecting concurrently")
+    parser.add_argument("--rest-concurrency", type=int, default=8)
+    parser.add_argument("--rest-duration", type=float, default=5.0)
+    parser.add_argument("--skip-rest", action="store_true")
+    parser.add_argument(
+        "--memory-connections",
+        type=int,
+        default=0,
+        help="Only measure ConnectionManager memory with this many idle in-process connections"
+    )
+    parser.add_argument(
+        "--memory-subscriptions",
+        type=int,
+        default=1,
+        help="Rooms each connection of the memory benchmark subscribes to (at most --rooms)"
+    )
+    parser.add_argument(
+        "--idle-sockets",
+        type=int,
+        default=0,
+        help="Instead of message traffic, hold this many idle sockets open and check the database pools"
+    )
+    parser.add_argument(
+        "--db-pool-size",
+        type=int,
+        help="DB_POOL_SIZE for the spawned server, with no overflow (Postgres, SQLite has no pool to cap)"
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    # SQLite gets no connection pool, a pool cap only proves anything against Postgres
+    if args.db_pool_size and args.url is None and not (args.database_url or "").startswith("postgresql"):
+        parser.error("--db-pool-size needs a Postgres --database-url")
+    return args
+
+def idle_failures(result: dict) -> List[str]:
+    # Why the idle benchmark failed, empty when idle sockets held no database connections
+    failures = []
+    if result["db_connections_checked_out"] > 0:
+        failures.append(f"{result['db_connections_checked_out']} database connections checked out by idle sockets")
+    if result["open_after_rest"] < result["idle_sockets"]:
+        failures.append(f"only {result['open_after_rest']} of {result['idle_sockets']} sockets still open")
+    rest = result["rest_while_idle"]
+    if rest["errors"] or not rest["requests"]:
+        failures.append(f"{rest['errors']} of {rest['requests']} REST requests failed")
+    return failures
+
+def write_report(report: dict, path: Optional[str]):
+    output = json.dumps(report, indent=2)
+    if path:
+        with open(path, "w") as f:
+            f.write(output + "\n")
+        print(f"Benchmark report written to {path}")
+    else:
+        print(output)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.memory_connections:
+        report = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "memory": asyncio.run(run_memory_benchmark(args))
+        }
+        write_report(report, args.output)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    server = None
+    base_url = args.url
+    try:
+        if base_url is None:
+            server = start_server(args, workdir)
+            base_url = f"http://127.0.0.1:{args.port}"
+        wait_for_server(base_url)
+
+        fixtures = setup_fixtures(base_url, args)
+        report = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {key: value for key, value in vars(args).items() if key != "output"}
+        }
+        if args.idle_sockets:
+            report["idle"] = asyncio.run(run_idle_benchmark(base_url, fixtures, args))
+        else:
+            report["websocket"] = asyncio.run(run_websocket_benchmark(base_url, fixtures, args))
+            report["rest"] = [] if args.skip_rest else run_rest_benchmarks(base_url, fixtures, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    write_report(report, args.output)
+    failures = idle_failures(report["idle"]) if args.idle_sockets else []
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backplane import BACKPLANE_URL
+from database import primary_session
+from metrics import Counter, Gauge
+from models import ChatRoom, User
+
+# Load environment variables
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", "10000"))
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", "60"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "50000"))
+# Evicting a live revocation would re-enable the token, so this one is sized generously
+REVOKED_TOKENS_SIZE = int(os.getenv("REVOKED_TOKENS_SIZE", "1000000"))
+
+# Bounded mapping where entries expire after a TTL and the least recently used go first
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+# Users by username and rooms by id. Entries are detached ORM instances,
+# read their columns but never add them to another session.
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+room_cache = TTLCache(ROOM_CACHE_SIZE, ROOM_CACHE_TTL)
+
+# Revoked tokens by SHA-256 digest, each kept until the token's exp. With a Redis
+# BACKPLANE_URL they are stored there too, so a logout on one worker counts on all of them.
+# Revocations this process has seen are remembered locally and skip the round trip.
+class RevokedTokens:
+    KEY_PREFIX = "chat:revoked:"
+
+    def __init__(self, url: str = BACKPLANE_URL, maxsize: int = REVOKED_TOKENS_SIZE):
+        self.url = url
+        self.local = TTLCache(maxsize, 0)
+        self._redis = None
+
+    @property
+    def shared(self) -> bool:
+        return self.url.startswith("redis://") or self.url.startswith("rediss://")
+
+    def _client(self):
+        if self._redis is None:
+            # Imported lazily so the in-memory setup works without redis installed
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.url, decode_responses=True)
+        return self._redis
+
+    async def add(self, digest: bytes, ttl: float):
+        self.local.set(digest, True, ttl=ttl)
+        if self.shared:
+            await self._client().set(f"{self.KEY_PREFIX}{digest.hex()}", 1, ex=max(1, math.ceil(ttl)))
+
+    async def contains(self, digest: bytes) -> bool:
+        if self.local.get(digest):
+            return True
+        if not self.shared:
+            return False
+        try:
+            ttl_ms = await self._client().pttl(f"{self.KEY_PREFIX}{digest.hex()}")
+        except Exception as e:
+            # Fail open like the rate limiter, an unreachable Redis shouldn't lock everyone out
+            print(f"Revoked token lookup failed: {e}")
+            return False
+        if ttl_ms > 0:
+            self.local.set(digest, True, ttl=ttl_ms / 1000)
+            return True
+        return False
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+# Decoded tokens by SHA-256 digest, each entry lives until the token's exp
+token_cache = TTLCache(TOKEN_CACHE_SIZE, 0)
+revoked_tokens = RevokedTokens()
+
+# Both are filled from the primary even when given a replica session: a lagging replica would
+# turn away users and rooms just created, or keep serving what was just changed until the TTL.
+async def get_cached_user(db: AsyncSession, username: str) -> Optional[User]:
+    user = user_cache.get(username)
+    if user is None:
+        async with primary_session(db) as primary:
+            result = await primary.execute(select(User).where(User.username == username))
+            user = result.scalars().first()
+            if user is not None:
+                primary.expunge(user)
+                user_cache.set(username, user)
+    return user
+
+async def get_cached_room(db: AsyncSession, room_id: int) -> Optional[ChatRoom]:
+    room = room_cache.get(room_id)
+    if room is None:
+        async with primary_session(db) as primary:
+            room = await primary.get(ChatRoom, room_id)
+            if room is not None:
+                primary.expunge(room)
+                room_cache.set(room_id, room)
+    return room
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    return {
+        "users": user_cache.stats(),
+        "rooms": room_cache.stats(),
+        "tokens": token_cache.stats()
+    }
+
+Counter(
+    "chat_cache_hits_total",
+    "Cache lookups served from memory",
+    ["cache"],
+    callback=lambda: {name: stats["hits"] for name, stats in cache_stats().items()}
+)
+Counter(
+    "chat_cache_misses_total",
+    "Cache lookups that fell through to the database",
+    ["cache"],
+    callback=lambda: {name: stats["misses"] for name, stats in cache_stats().items()}
+)
+Gauge(
+    "chat_cache_entries",
+    "Entries held per cache",
+    ["cache"],
+    callback=lambda: {name: stats["size"] for name, stats in cache_stats().items()}
+)
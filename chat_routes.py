@@ -1,49 +1,84 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from database import get_db
-from models import ChatRoom, Message, User
-from schemas import ChatRoomCreate, ChatRoomResponse, MessageResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import List, Optional
+from database import get_async_read_db, get_async_write_db
+from models import ChatRoom, Message, MessageReaction, RoomEvent, User
+from schemas import ChatRoomCreate, ChatRoomResponse, MessagePage, RetentionPolicy, SearchPage
 from auth import get_current_user, require_admin
+from cache import get_cached_room, room_cache
+from events import reaction_counts
+from export import EXPORT_MEDIA_TYPES, export_messages
+from message_cache import recent_events, recent_messages
+from retention import retained, retention_floor
+from search import decode_cursor, encode_cursor, search_messages
+from serializers import json_response
 
 router = APIRouter(prefix="/rooms", tags=["chat rooms"])
 
+def message_summaries():
+    # Only the columns history and search return, with the author joined in the same query
+    return (
+        select(
+            Message.id, Message.content, Message.timestamp, Message.edited_at,
+            Message.user_id, Message.room_id, User.username
+        )
+        .join(User, Message.user_id == User.id)
+    )
+
+def summarize(row, reactions: Optional[dict] = None) -> dict:
+    return {
+        "id": row.id,
+        "content": row.content,
+        "timestamp": row.timestamp,
+        "edited_at": row.edited_at,
+        "user_id": row.user_id,
+        "room_id": row.room_id,
+        "user": {"id": row.user_id, "username": row.username},
+        "reactions": reactions or {}
+    }
+
 @router.post("/", response_model=ChatRoomResponse, status_code=status.HTTP_201_CREATED)
-def create_chat_room(
+async def create_chat_room(
     room: ChatRoomCreate, 
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_write_db),
     current_user: User = Depends(require_admin)  # Only admins can create rooms
 ):
     # Check if room name already exists
-    existing_room = db.query(ChatRoom).filter(ChatRoom.name == room.name).first()
+    result = await db.execute(select(ChatRoom).where(ChatRoom.name == room.name))
+    existing_room = result.scalars().first()
     if existing_room:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Room with this name already exists"
         )
     
-    db_room = ChatRoom(name=room.name, description=room.description)
+    db_room = ChatRoom(name=room.name, description=room.description, retention_days=room.retention_days)
     db.add(db_room)
-    db.commit()
-    db.refresh(db_room)
+    await db.commit()
+    await db.refresh(db_room)
+    room_cache.invalidate(db_room.id)
     
     return db_room
 
 @router.get("/", response_model=List[ChatRoomResponse])
-def get_chat_rooms(
-    db: Session = Depends(get_db),
+async def get_chat_rooms(
+    db: AsyncSession = Depends(get_async_read_db),
     current_user: User = Depends(get_current_user)
 ):
-    rooms = db.query(ChatRoom).all()
+    result = await db.execute(select(ChatRoom))
+    rooms = result.scalars().all()
     return rooms
 
 @router.get("/{room_id}", response_model=ChatRoomResponse)
-def get_chat_room(
+async def get_chat_room(
     room_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_read_db),
     current_user: User = Depends(get_current_user)
 ):
-    room = db.query(ChatRoom).filter(ChatRoom.id == room_id).first()
+    room = await get_cached_room(db, room_id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -51,47 +86,175 @@ def get_chat_room(
         )
     return room
 
-@router.get("/{room_id}/messages", response_model=List[MessageResponse])
-def get_room_messages(
+@router.get("/{room_id}/messages", response_model=MessagePage)
+async def get_room_messages(
     room_id: int,
-    skip: int = 0,
-    limit: int = 50,
-    db: Session = Depends(get_db),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_read_db),
     current_user: User = Depends(get_current_user)
 ):
     # Check if room exists
-    room = db.query(ChatRoom).filter(ChatRoom.id == room_id).first()
+    room = await get_cached_room(db, room_id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Room not found"
         )
     
-    # Get messages with cursor-based pagination (newest first)
-    messages = (
-        db.query(Message)
-        .filter(Message.room_id == room_id)
-        .order_by(Message.timestamp.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
+    # Keyset pagination over the (room_id, id) index, one extra row tells us if more exist
+    query = (
+        message_summaries()
+        .where(Message.room_id == room_id)
+        .limit(limit + 1)
+    )
+    # Expired messages are hidden until archived, and older partitions are skipped
+    floor = retention_floor(room)
+    if floor is not None:
+        query = query.where(retained(floor))
+    # Both together select the range between them, paged from after_id
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    if after_id is not None:
+        query = query.where(Message.id > after_id).order_by(Message.id.asc())
+    else:
+        query = query.order_by(Message.id.desc())
+    
+    result = await db.execute(query)
+    messages = list(result.all())
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after_id is not None:
+        messages.reverse()
+    
+    # Older pages exist unless we walked off the start of the room
+    if after_id is not None:
+        next_before_id = messages[-1].id if messages else None
+    else:
+        next_before_id = messages[-1].id if messages and has_more else None
+    next_after_id = messages[0].id if messages else after_id
+    reactions = await reaction_counts(db, (row.id for row in messages))
+    
+    return json_response({
+        "messages": [summarize(row, reactions.get(row.id)) for row in messages],
+        "before_id": next_before_id,
+        "after_id": next_after_id
+    })
+
+@router.get("/{room_id}/search", response_model=SearchPage)
+async def search_room_messages(
+    room_id: int,
+    q: str = Query(..., min_length=1, max_length=200),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: User = Depends(get_current_user)
+):
+    # Check if room exists
+    room = await get_cached_room(db, room_id)
+    if not room:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Room not found"
+        )
+    
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    
+    # Ranked ids from the full-text index, then the messages themselves by primary key
+    hits = await search_messages(db, room_id, q, limit + 1, after, retention_floor(room))
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    
+    result = await db.execute(
+        message_summaries().where(Message.id.in_([message_id for message_id, _, _ in hits]))
     )
+    messages = {row.id: summarize(row) for row in result.all()}
+    
+    results = [
+        {"message": messages[message_id], "highlight": highlight, "score": score}
+        for message_id, score, highlight in hits
+        if message_id in messages
+    ]
+    next_cursor = encode_cursor(hits[-1][1], hits[-1][0]) if has_more else None
     
-    return messages
+    return json_response({"results": results, "next_cursor": next_cursor})
+
+@router.get("/{room_id}/export")
+async def export_room_messages(
+    room_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    compress: bool = False,
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: User = Depends(require_admin)  # Only admins can export whole rooms
+):
+    # Check if room exists
+    room = await get_cached_room(db, room_id)
+    if not room:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Room not found"
+        )
+    
+    # Streamed oldest first from a server-side cursor, never held in memory as a whole
+    filename = f"room-{room_id}.{format}" + (".gz" if compress else "")
+    return StreamingResponse(
+        export_messages(room_id, format, since, until, retention_floor(room), compress),
+        media_type="application/gzip" if compress else EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @router.delete("/{room_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_chat_room(
+async def delete_chat_room(
     room_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_write_db),
     current_user: User = Depends(require_admin)  # Only admins can delete rooms
 ):
-    room = db.query(ChatRoom).filter(ChatRoom.id == room_id).first()
+    room = await db.get(ChatRoom, room_id)
     if not room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Room not found"
         )
     
-    db.delete(room)
-    db.commit()
+    # Messages and their event log go first, in one statement each rather than loaded
+    # and deleted one by one
+    await db.execute(delete(MessageReaction).where(MessageReaction.room_id == room_id))
+    await db.execute(delete(RoomEvent).where(RoomEvent.room_id == room_id))
+    await db.execute(delete(Message).where(Message.room_id == room_id))
+    await db.delete(room)
+    await db.commit()
+    room_cache.invalidate(room_id)
+    recent_messages.invalidate(room_id)
+    recent_events.invalidate(room_id)
     return None
+
+@router.put("/{room_id}/retention", response_model=ChatRoomResponse)
+async def set_room_retention(
+    room_id: int,
+    policy: RetentionPolicy,
+    db: AsyncSession = Depends(get_async_write_db),
+    current_user: User = Depends(require_admin)  # Only admins can change retention
+):
+    room = await db.get(ChatRoom, room_id)
+    if not room:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Room not found"
+        )
+    
+    # Messages past the new retention are archived by the next maintenance pass
+    room.retention_days = policy.retention_days
+    await db.commit()
+    await db.refresh(room)
+    room_cache.invalidate(room_id)
+    recent_messages.invalidate(room_id)
+    return room
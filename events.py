@@ -0,0 +1,297 @@
+"""
+Per-room event sequence, event log and replay.
+
+Everything published to a room through publish_event takes the room's next sequence
+number from the backplane, so all workers share one sequence per room, and is appended
+to the room_events table through the ingestion pipeline. New messages are logged without
+their frame, which is rebuilt from the messages table on replay. Edits, deletes and
+reactions are small delta events carrying only what changed:
+
+    {"seq": 12, "type": "message_edited", "room_id": 1, "message_id": ..., "content": ..., "edited_at": ...}
+    {"seq": 13, "type": "reaction", "room_id": 1, "message_id": ..., "emoji": "+1", "user_id": 7, "delta": 1}
+    {"seq": 14, "type": "message_deleted", "room_id": 1, "message_id": ...}
+
+A client reconnecting with since_seq gets the events it missed in one replay frame,
+from the room's in-memory tail when it reaches back far enough and from the log
+otherwise. Clients that missed more than REPLAY_MAX_EVENTS get the history frame
+instead. Presence keeps its own version numbers and is not logged.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import and_, delete, func, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backplane import sequenced_frame
+from database import AsyncSessionLocal, add_column_if_missing
+from ingestion import ingestor
+from message_cache import recent_events
+from models import Message, MessageReaction, RoomEvent, User
+from retention import expired_id, retained
+from serializers import dumps
+from websocket_manager import manager
+
+# Load environment variables
+load_dotenv()
+
+# Clients that missed more events than this get the history frame instead of a replay
+REPLAY_MAX_EVENTS = int(os.getenv("REPLAY_MAX_EVENTS", "1000"))
+# Longest reaction accepted, matches message_reactions.emoji
+MAX_REACTION_LENGTH = 32
+
+def setup_events(engine: Engine):
+    add_column_if_missing(engine, "messages", "edited_at", "TIMESTAMP WITH TIME ZONE")
+
+async def sequence_floor(room_id: int) -> int:
+    # Highest logged seq, asked for by the backplane only when the room's counter is
+    # missing (first event since a restart of the in-memory backplane or of Redis).
+    # Events this process numbered before that are still buffered are written out first.
+    await ingestor.flush()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(func.max(RoomEvent.seq)).where(RoomEvent.room_id == room_id))
+        return result.scalar() or 0
+
+async def publish_event(event: dict, room_id: int, message_id: Optional[int]) -> int:
+    # Broadcasts a room event under the next seq and logs it, returns the seq
+    seq = await manager.broadcast_to_room(event, room_id, sequence_floor)
+    ingestor.log_event({
+        "room_id": room_id,
+        "seq": seq,
+        "type": event["type"],
+        "message_id": message_id,
+        # Deltas are tiny, encoding them a second time beats passing frames back from the backplane
+        "frame": None if event["type"] == "message" else sequenced_frame(seq, dumps(event))
+    })
+    return seq
+
+async def current_seq(db: AsyncSession, room_id: int) -> int:
+    # Last event of the room, sent with the history frame and read before the history is
+    # loaded. Reaction deltas can't be applied twice, so it must be exact: the last one
+    # delivered here, else the backplane's counter, else (no event since a restart) the log.
+    seq = recent_events.last_seq(room_id)
+    if seq is None:
+        seq = await manager.backplane.get_sequence(room_id)
+    if seq is None:
+        await ingestor.flush()
+        result = await db.execute(select(func.max(RoomEvent.seq)).where(RoomEvent.room_id == room_id))
+        seq = result.scalar() or 0
+    return seq
+
+def message_rows():
+    # Columns of a message frame, with the seq of the event that announced the message
+    return (
+        select(
+            Message.id, Message.content, Message.timestamp, Message.edited_at,
+            Message.user_id, User.username, RoomEvent.seq
+        )
+        .join(User, Message.user_id == User.id)
+        .outerjoin(RoomEvent, and_(
+            RoomEvent.room_id == Message.room_id,
+            RoomEvent.message_id == Message.id,
+            RoomEvent.type == "message"
+        ))
+    )
+
+def message_event(row, room_id: int, reactions: Optional[Dict[str, int]] = None) -> dict:
+    # Same keys, in the same order, as the frame broadcast when the message was sent
+    event = {"seq": row.seq} if row.seq else {}
+    event.update({
+        "type": "message",
+        "id": row.id,
+        "content": row.content,
+        "username": row.username,
+        "user_id": row.user_id,
+        "timestamp": row.timestamp.isoformat(),
+        "room_id": room_id
+    })
+    if row.edited_at is not None:
+        event["edited_at"] = row.edited_at.isoformat()
+    if reactions:
+        event["reactions"] = reactions
+    return event
+
+async def reaction_counts(db: AsyncSession, message_ids: Iterable[int]) -> Dict[int, Dict[str, int]]:
+    # {message_id: {emoji: count}} for the messages that have reactions
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+    result = await db.execute(
+        select(MessageReaction.message_id, MessageReaction.emoji, func.count())
+        .where(MessageReaction.message_id.in_(message_ids))
+        .group_by(MessageReaction.message_id, MessageReaction.emoji)
+    )
+    counts: Dict[int, Dict[str, int]] = {}
+    for message_id, emoji, count in result.all():
+        counts.setdefault(message_id, {})[emoji] = count
+    return counts
+
+async def message_frames(db: AsyncSession, room_id: int, rows: List) -> List[Tuple[int, str]]:
+    # (message_id, frame) for rows of message_rows(), reactions counted in one query
+    reactions = await reaction_counts(db, (row.id for row in rows))
+    return [(row.id, dumps(message_event(row, room_id, reactions.get(row.id)))) for row in rows]
+
+async def replay(
+    db: AsyncSession,
+    room_id: int,
+    since_seq: int,
+    min_id: Optional[int] = None
+) -> Optional[Tuple[List[str], int]]:
+    # Frames of the events after since_seq and the seq they bring the client to. None
+    # when the client is too far behind (or ahead, after a reset) and needs the history.
+    frames = recent_events.since(room_id, since_seq)
+    if frames is not None:
+        return frames, recent_events.last_seq(room_id)
+
+    query = (
+        select(RoomEvent.seq, RoomEvent.type, RoomEvent.message_id, RoomEvent.frame)
+        .where(RoomEvent.room_id == room_id, RoomEvent.seq > since_seq)
+        .order_by(RoomEvent.seq)
+        .limit(REPLAY_MAX_EVENTS + 1)
+    )
+    events = (await db.execute(query)).all()
+    if len(events) > REPLAY_MAX_EVENTS:
+        return None
+    logged = events[-1].seq if events else since_seq
+    first = recent_events.first_seq(room_id)
+    if first is not None and first > logged + 1:
+        # Events between the log and the tail are still in the ingestion buffer
+        await ingestor.flush()
+        events = (await db.execute(query)).all()
+        if len(events) > REPLAY_MAX_EVENTS:
+            return None
+        logged = events[-1].seq if events else since_seq
+        if first > logged + 1:
+            # Buffered by another worker
+            return None
+    # Events delivered here but not yet written to the log
+    tail = recent_events.after(room_id, logged)
+    if not events and not tail:
+        if since_seq > await current_seq(db, room_id):
+            return None
+        return [], since_seq
+
+    # Messages are rebuilt as they read now, so the edits and reactions that follow
+    # them are already applied and left out
+    message_ids = [event.message_id for event in events if event.type == "message"]
+    rebuilt: Dict[int, str] = {}
+    if message_ids:
+        query = message_rows().where(Message.room_id == room_id, Message.id.in_(message_ids))
+        if min_id is not None:
+            query = query.where(retained(min_id))
+        rows = (await db.execute(query)).all()
+        rebuilt = dict(await message_frames(db, room_id, rows))
+
+    frames = []
+    for event in events:
+        if event.type == "message":
+            frame = rebuilt.get(event.message_id)
+        elif event.message_id in rebuilt or expired_id(event.message_id, min_id):
+            frame = None
+        else:
+            # NULL for the edits of a deleted message
+            frame = event.frame
+        if frame is not None:
+            frames.append(frame)
+    frames.extend(frame for _, frame in tail)
+    return frames, tail[-1][0] if tail else events[-1].seq
+
+async def _write_message_change(message_id: int, *statements) -> bool:
+    # Runs the statements in one transaction, False when the first one matched no row.
+    # A message still in this process's ingestion buffer is written out first.
+    if ingestor.is_pending(message_id):
+        await ingestor.flush()
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(statements[0])
+        if not result.rowcount:
+            await db.rollback()
+            return False
+        for statement in statements[1:]:
+            await db.execute(statement)
+        await db.commit()
+    return True
+
+async def edit_message(room_id: int, message_id: int, user_id: int, content: str) -> bool:
+    # Only the author edits, False when the message isn't theirs or doesn't exist
+    edited_at = datetime.now(timezone.utc)
+    changed = await _write_message_change(
+        message_id,
+        update(Message)
+        .where(Message.id == message_id, Message.room_id == room_id, Message.user_id == user_id)
+        .values(content=content, edited_at=edited_at)
+    )
+    if changed:
+        await publish_event({
+            "type": "message_edited",
+            "room_id": room_id,
+            "message_id": message_id,
+            "content": content,
+            "edited_at": edited_at.isoformat()
+        }, room_id, message_id)
+    return changed
+
+async def delete_message(room_id: int, message_id: int, user_id: int, is_admin: bool = False) -> bool:
+    # The author or an admin deletes. The message and its reactions are removed and the
+    # logged edits lose their frames, only the deletion itself is replayed.
+    condition = [Message.id == message_id, Message.room_id == room_id]
+    if not is_admin:
+        condition.append(Message.user_id == user_id)
+    # Edits still waiting to be logged must be written before their frames are cleared
+    await ingestor.flush()
+    changed = await _write_message_change(
+        message_id,
+        delete(Message).where(*condition),
+        delete(MessageReaction).where(MessageReaction.message_id == message_id),
+        update(RoomEvent)
+        .where(RoomEvent.room_id == room_id, RoomEvent.message_id == message_id)
+        .values(frame=None)
+    )
+    if changed:
+        await publish_event(
+            {"type": "message_deleted", "room_id": room_id, "message_id": message_id},
+            room_id,
+            message_id
+        )
+    return changed
+
+async def react(room_id: int, message_id: int, user_id: int, emoji: str, added: bool = True) -> bool:
+    # Adds or removes the user's reaction, False when the message doesn't exist. Repeats
+    # are accepted but publish nothing.
+    if ingestor.is_pending(message_id):
+        await ingestor.flush()
+    async with AsyncSessionLocal() as db:
+        if added:
+            exists = await db.execute(
+                select(Message.id).where(Message.id == message_id, Message.room_id == room_id)
+            )
+            if exists.first() is None:
+                return False
+            try:
+                db.add(MessageReaction(message_id=message_id, emoji=emoji, user_id=user_id, room_id=room_id))
+                await db.commit()
+            except IntegrityError:
+                return True
+        else:
+            result = await db.execute(
+                delete(MessageReaction).where(
+                    MessageReaction.message_id == message_id,
+                    MessageReaction.emoji == emoji,
+                    MessageReaction.user_id == user_id,
+                    MessageReaction.room_id == room_id
+                )
+            )
+            await db.commit()
+            if not result.rowcount:
+                return True
+
+    await publish_event({
+        "type": "reaction",
+        "room_id": room_id,
+        "message_id": message_id,
+        "emoji": emoji,
+        "user_id": user_id,
+        "delta": 1 if added else -1
+    }, room_id, message_id)
+    return True
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy import insert, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from database import AsyncSessionLocal
+from metrics import MESSAGE_FLUSH_FAILURES, MESSAGE_FLUSH_SECONDS, MESSAGES_INGESTED, MESSAGES_PERSISTED
+from models import Message, RoomEvent
+
+# Load environment variables
+load_dotenv()
+
+# Flush once this many messages are pending, or after the interval, whichever comes first
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "500"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+# "broadcast" acks a message once it is broadcast, "persist" only after its batch is written
+MESSAGE_DURABILITY = os.getenv("MESSAGE_DURABILITY", "broadcast")
+# Upper bound on unwritten messages kept for retry while the database is unavailable
+MESSAGE_MAX_PENDING = int(os.getenv("MESSAGE_MAX_PENDING", "100000"))
+
+# Snowflake-style ids: milliseconds since ID_EPOCH_MS, worker id, per-millisecond sequence.
+# 41 + 6 + 6 bits keeps ids below 2**53 so JavaScript clients can use them as numbers.
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+WORKER_COUNT = 1 << WORKER_BITS
+# Unique per worker process across all workers and pods. Without it a free one is leased
+# from the backplane at startup (see Backplane.lease_worker_id).
+WORKER_ID = None if os.getenv("ID_WORKER_ID") is None else int(os.environ["ID_WORKER_ID"])
+if WORKER_ID is not None and not 0 <= WORKER_ID < WORKER_COUNT:
+    raise ValueError(f"ID_WORKER_ID must be between 0 and {WORKER_COUNT - 1}")
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id: Optional[int] = WORKER_ID):
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        if self.worker_id is None:
+            raise RuntimeError("No message id worker number, set ID_WORKER_ID or lease one at startup")
+        now = int(time.time() * 1000) - ID_EPOCH_MS
+        if now < self._last_ms:
+            # Clock moved backwards (or we borrowed ahead), stay monotonic
+            now = self._last_ms
+
+        if now == self._last_ms:
+            self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+            if self._sequence == 0:
+                # Sequence exhausted for this millisecond, borrow the next one
+                now += 1
+        else:
+            self._sequence = 0
+
+        self._last_ms = now
+        return (now << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+def snowflake_floor(when: datetime) -> int:
+    # Smallest id generated at or after `when`, ids below it are older
+    return (int(when.timestamp() * 1000) - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)
+
+def snowflake_time(message_id: int) -> datetime:
+    milliseconds = (message_id >> (WORKER_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS
+    return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+# Ids below this predate snowflake ids: autoincrement ids of messages written before
+# them, far below any id generated since ID_EPOCH_MS. Their age is only in their timestamp.
+LEGACY_ID_LIMIT = snowflake_floor(datetime(2024, 2, 1, tzinfo=timezone.utc))
+
+# Columns holding message ids, INTEGER on Postgres databases created before snowflake ids
+MESSAGE_ID_COLUMNS = [("messages", "id"), ("message_reactions", "message_id"), ("room_events", "message_id")]
+
+def setup_ids(engine: Engine):
+    # Widens the message id columns of older Postgres databases to BIGINT, snowflake ids
+    # overflow INTEGER and every batch would fail to insert. Rewrites the tables once.
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for table, column in MESSAGE_ID_COLUMNS:
+            data_type = conn.execute(text(
+                "SELECT data_type FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"
+            ), {"table": table, "column": column}).scalar()
+            if data_type == "integer":
+                print(f"Widening {table}.{column} to BIGINT")
+                conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT"))
+
+# Write-behind pipeline: messages get their id and timestamp up front and are
+# inserted in batched multi-row INSERTs instead of one transaction each. Room event
+# log rows (see events.py) ride along in the same transactions.
+class MessageIngestor:
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval_ms: int = MESSAGE_FLUSH_INTERVAL_MS,
+        durability: str = MESSAGE_DURABILITY
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.durability = durability
+        self.ids = SnowflakeGenerator()
+        self._pending: List[dict] = []
+        self._pending_events: List[dict] = []
+        # Senders waiting for their message to be written, by message id
+        self._waiters: Dict[int, asyncio.Future] = {}
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # Never cancel the flusher halfway through writing a batch
+            async with self._flush_lock:
+                self._task.cancel()
+            self._task = None
+        # Write whatever is still buffered
+        await self.flush()
+
+    async def submit(self, content: str, user_id: int, room_id: int) -> dict:
+        await self.start()
+
+        row = {
+            "id": self.ids.next_id(),
+            "content": content,
+            "timestamp": datetime.now(timezone.utc),
+            "user_id": user_id,
+            "room_id": room_id
+        }
+        self._pending.append(row)
+        self._has_pending.set()
+        MESSAGES_INGESTED.inc()
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+
+        if self.durability == "persist":
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[row["id"]] = waiter
+            await waiter
+
+        return row
+
+    def log_event(self, row: dict):
+        # Appends a room_events row, written with the next batch
+        self._pending_events.append(row)
+        self._has_pending.set()
+
+    def is_pending(self, message_id: int) -> bool:
+        # True while the message is waiting for its batch
+        return any(row["id"] == message_id for row in self._pending)
+
+    async def flush(self) -> bool:
+        async with self._flush_lock:
+            batch, events, waiters = self._pending, self._pending_events, self._waiters
+            self._pending, self._pending_events, self._waiters = [], [], {}
+            if not batch and not events:
+                return True
+
+            started = time.perf_counter()
+            dropped: Dict[int, Exception] = {}
+            try:
+                try:
+                    async with self.session_factory() as db:
+                        if batch:
+                            await db.execute(insert(Message).values(batch))
+                        if events:
+                            await db.execute(insert(RoomEvent).values(events))
+                        await db.commit()
+                except IntegrityError:
+                    # A bad row (e.g. its room was deleted) must not sink the whole batch
+                    dropped = await self._insert_one_by_one(Message, batch)
+                    await self._insert_one_by_one(RoomEvent, events)
+            except Exception as e:
+                MESSAGE_FLUSH_FAILURES.inc()
+                print(f"Message flush failed: {e}")
+                if waiters:
+                    # Senders waiting on persistence are told it failed
+                    for waiter in waiters.values():
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                elif len(self._pending) + len(batch) <= MESSAGE_MAX_PENDING:
+                    # Already broadcast, keep them for the next flush
+                    self._pending[:0] = batch
+                    self._has_pending.set()
+                else:
+                    print(f"Dropped {len(batch)} unwritten messages")
+                if len(self._pending_events) + len(events) <= MESSAGE_MAX_PENDING:
+                    self._pending_events[:0] = events
+                    self._has_pending.set()
+                else:
+                    print(f"Dropped {len(events)} unwritten room events")
+                return False
+
+            MESSAGE_FLUSH_SECONDS.observe(time.perf_counter() - started)
+            MESSAGES_PERSISTED.inc(len(batch) - len(dropped))
+            for message_id, waiter in waiters.items():
+                if waiter.done():
+                    continue
+                if message_id in dropped:
+                    waiter.set_exception(dropped[message_id])
+                else:
+                    waiter.set_result(None)
+            return True
+
+    async def _insert_one_by_one(self, model, batch: List[dict]) -> Dict[int, Exception]:
+        # Returns the errors of the rows that could not be written, by row id (or seq)
+        dropped = {}
+        async with self.session_factory() as db:
+            for row in batch:
+                try:
+                    await db.execute(insert(model).values(row))
+                    await db.commit()
+                except IntegrityError as e:
+                    await db.rollback()
+                    key = row.get("id", row.get("seq"))
+                    dropped[key] = e
+                    print(f"Dropped {model.__tablename__} row {key}: {e.orig}")
+        return dropped
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            if not self._batch_full.is_set():
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            self._has_pending.clear()
+            self._batch_full.clear()
+            if not await self.flush():
+                # A failed flush kept its rows, back off before retrying
+                await asyncio.sleep(self.flush_interval)
+
+# Global message ingestor instance
+ingestor = MessageIngestor()
@@ -1,20 +1,52 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 import os
 from dotenv import load_dotenv
+from sqlalchemy import text
 
 # Load environment variables
 load_dotenv()
 
-from database import engine
+from database import engine, pool_stats
 from models import Base
 import auth_routes
 import chat_routes
 import websocket_routes
+from websocket_manager import manager
+from ingestion import WORKER_COUNT, WORKER_ID, ingestor, setup_ids
+from cache import cache_stats, revoked_tokens
+from auth import start_password_pool, shutdown_password_pool
+from rate_limit import rate_limiter
+from search import setup_search
+from retention import maintenance, setup_retention
+from events import setup_events
+import metrics
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Postgres advisory lock so workers starting together don't run the schema setup at once
+SCHEMA_LOCK_ID = 0x63686173
+
+def setup_database():
+    # Runs at startup, not on import: password pool workers are spawned and re-import this
+    # module when the app is started with `python main.py`
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as lock:
+        if postgres:
+            lock.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+        try:
+            # Create database tables
+            Base.metadata.create_all(bind=engine)
+            # BIGINT message ids on databases created before snowflake ids (Postgres)
+            setup_ids(engine)
+            # Full-text index over messages (Postgres tsvector or SQLite FTS5)
+            setup_search(engine)
+            # Retention column and upcoming message partitions (Postgres)
+            setup_retention(engine)
+            # Edit timestamp column on databases created before edits existed
+            setup_events(engine)
+        finally:
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_ID})
 
 # Create FastAPI app
 app = FastAPI(
@@ -32,6 +64,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    setup_database()
+    # Connect the broadcast backplane before accepting sockets
+    await manager.start()
+    # Message ids need a worker number no other worker uses, startup fails without one
+    ingestor.ids.worker_id = await manager.backplane.lease_worker_id(WORKER_COUNT, WORKER_ID)
+    await ingestor.start()
+    await maintenance.start()
+    start_password_pool()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await maintenance.stop()
+    await manager.stop()
+    # Write out messages still waiting in the ingestion buffer
+    await ingestor.stop()
+    shutdown_password_pool()
+    await rate_limiter.close()
+    await revoked_tokens.close()
+
+# Sampled per-request timing for /metrics
+if metrics.METRICS_SAMPLE_RATE > 0:
+    app.middleware("http")(metrics.sample_request_timing)
+
 # Include routers
 app.include_router(auth_routes.router)
 app.include_router(chat_routes.router)
@@ -53,7 +110,12 @@ def get_chat_client():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "caches": cache_stats(), "database_pools": pool_stats()}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,242 @@
+import asyncio
+import os
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+
+from serializers import dumps, loads
+
+# Load environment variables
+load_dotenv()
+
+# Recent messages kept per room, enough to serve the join backlog
+RECENT_MESSAGES_PER_ROOM = int(os.getenv("RECENT_MESSAGES_PER_ROOM", "50"))
+# Least recently used rooms are evicted past either limit
+RECENT_CACHE_MAX_ROOMS = int(os.getenv("RECENT_CACHE_MAX_ROOMS", "10000"))
+RECENT_CACHE_MAX_BYTES = int(os.getenv("RECENT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Sequenced events kept per subscribed room for clients resuming with since_seq
+RECENT_EVENTS_PER_ROOM = int(os.getenv("RECENT_EVENTS_PER_ROOM", "256"))
+
+# Loads (message_id, frame) pairs for a room from the database, oldest first
+RoomLoader = Callable[[int, int], Awaitable[List[Tuple[int, str]]]]
+
+# Events that change a message already sent, applied to its cached frame
+MESSAGE_UPDATE_TYPES = {"message_edited", "message_deleted", "reaction"}
+
+def apply_update(message_frame: str, kind: str, event: dict) -> Optional[str]:
+    # The message frame as it reads after the event, None once deleted
+    if kind == "message_deleted":
+        return None
+    message = loads(message_frame)
+    if kind == "message_edited":
+        message["content"] = event["content"]
+        message["edited_at"] = event["edited_at"]
+    else:
+        reactions = message.setdefault("reactions", {})
+        count = reactions.get(event["emoji"], 0) + event["delta"]
+        if count > 0:
+            reactions[event["emoji"]] = count
+        else:
+            reactions.pop(event["emoji"], None)
+    return dumps(message)
+
+class RoomBuffer:
+    def __init__(self, maxlen: int):
+        self.maxlen = maxlen
+        self.frames: Deque[Tuple[int, str]] = deque()
+        self.size = 0
+
+    def append(self, message_id: int, frame: str) -> int:
+        # Returns the change in buffered bytes
+        delta = len(frame)
+        if len(self.frames) >= self.maxlen:
+            delta -= len(self.frames.popleft()[1])
+        self.frames.append((message_id, frame))
+        self.size += delta
+        return delta
+
+    def replace(self, message_id: int, frame: Optional[str]) -> int:
+        # Swaps the frame of a buffered message, None removes it. Returns the change in bytes.
+        for index, (buffered_id, old) in enumerate(self.frames):
+            if buffered_id == message_id:
+                if frame is None:
+                    del self.frames[index]
+                    delta = -len(old)
+                else:
+                    self.frames[index] = (message_id, frame)
+                    delta = len(frame) - len(old)
+                self.size += delta
+                return delta
+        return 0
+
+# Per-room ring buffers of pre-serialized message frames, warmed lazily from the database
+class RecentMessageCache:
+    def __init__(
+        self,
+        per_room: int = RECENT_MESSAGES_PER_ROOM,
+        max_rooms: int = RECENT_CACHE_MAX_ROOMS,
+        max_bytes: int = RECENT_CACHE_MAX_BYTES
+    ):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._rooms: "OrderedDict[int, RoomBuffer]" = OrderedDict()
+        # Rooms being loaded, with the frames broadcast and the updates made while the query runs
+        self._warming: Dict[int, Tuple[asyncio.Future, List[Tuple[int, str]], List[int]]] = {}
+
+    def append(self, room_id: int, message_id: int, frame: str):
+        buffer = self._rooms.get(room_id)
+        if buffer is not None:
+            self.total_bytes += buffer.append(message_id, frame)
+            self._rooms.move_to_end(room_id)
+            self._evict()
+        elif room_id in self._warming:
+            self._warming[room_id][1].append((message_id, frame))
+
+    def update(self, room_id: int, message_id: int, change: Callable[[str], Optional[str]]):
+        # Rewrites a buffered message after an edit, delete or reaction. change gets the
+        # frame and returns the new one, or None to drop the message.
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            if room_id in self._warming:
+                self._warming[room_id][2].append(message_id)
+            return
+        for buffered_id, frame in buffer.frames:
+            if buffered_id == message_id:
+                self.total_bytes += buffer.replace(message_id, change(frame))
+                return
+
+    def apply(self, room_id: int, kind: str, message_id: int, frame: str):
+        # The event frame is only decoded when its message is buffered
+        self.update(room_id, message_id, lambda message_frame: apply_update(message_frame, kind, loads(frame)))
+
+    async def get_recent(self, room_id: int, limit: int, loader: RoomLoader) -> List[str]:
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = await self._warm(room_id, loader)
+        else:
+            self._rooms.move_to_end(room_id)
+        frames = [frame for _, frame in buffer.frames]
+        return frames[-limit:] if limit < len(frames) else frames
+
+    def invalidate(self, room_id: int):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.total_bytes -= buffer.size
+
+    async def _warm(self, room_id: int, loader: RoomLoader) -> RoomBuffer:
+        # Only one query per room, concurrent joins wait for it
+        if room_id in self._warming:
+            return await asyncio.shield(self._warming[room_id][0])
+
+        future = asyncio.get_running_loop().create_future()
+        self._warming[room_id] = (future, [], [])
+        try:
+            rows = await loader(room_id, self.per_room)
+            _, live, changes = self._warming[room_id]
+            merged = dict(rows)
+            merged.update(live)
+
+            buffer = RoomBuffer(self.per_room)
+            for message_id in sorted(merged):
+                buffer.append(message_id, merged[message_id])
+
+            # The load may or may not have seen messages changed while it ran, serve the
+            # result this once and leave the room to be loaded again
+            if not changes:
+                self._rooms[room_id] = buffer
+                self.total_bytes += buffer.size
+                self._evict()
+            future.set_result(buffer)
+            return buffer
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting, don't leave the exception unretrieved
+            future.exception()
+            raise
+        finally:
+            del self._warming[room_id]
+
+    def _evict(self):
+        while self._rooms and (len(self._rooms) > self.max_rooms or self.total_bytes > self.max_bytes):
+            _, buffer = self._rooms.popitem(last=False)
+            self.total_bytes -= buffer.size
+
+class EventTail:
+    def __init__(self, maxlen: int):
+        self.events: Deque[Tuple[int, int, str]] = deque(maxlen=maxlen)
+        # Every event from this seq on is in the tail, 0 until the first one arrives
+        self.start = 0
+
+# The last events of each subscribed room as (seq, message_id, frame). A tail only
+# starts once this process subscribes to the room, so it holds every event since.
+class RecentEventCache:
+    def __init__(self, per_room: int = RECENT_EVENTS_PER_ROOM):
+        self.per_room = per_room
+        self._rooms: Dict[int, EventTail] = {}
+
+    def append(self, room_id: int, seq: int, message_id: int, frame: str):
+        tail = self._rooms.get(room_id)
+        if tail is None:
+            tail = self._rooms[room_id] = EventTail(self.per_room)
+            tail.start = seq
+        elif len(tail.events) == tail.events.maxlen:
+            tail.start = tail.events[0][0] + 1
+        tail.events.append((seq, message_id, frame))
+
+    def last_seq(self, room_id: int) -> Optional[int]:
+        tail = self._rooms.get(room_id)
+        return tail.events[-1][0] if tail and tail.events else None
+
+    def since(self, room_id: int, seq: int) -> Optional[List[str]]:
+        # Frames of the events after seq, None when the tail doesn't reach back that far
+        # or seq is ahead of the room (e.g. the sequence was reset)
+        tail = self._rooms.get(room_id)
+        if tail is None or not tail.events or not tail.start - 1 <= seq <= tail.events[-1][0]:
+            return None
+        return [frame for event_seq, _, frame in tail.events if event_seq > seq]
+
+    def first_seq(self, room_id: int) -> Optional[int]:
+        # Every event from this seq on is in the tail, None without one
+        tail = self._rooms.get(room_id)
+        return tail.start if tail and tail.events else None
+
+    def after(self, room_id: int, seq: int) -> List[Tuple[int, str]]:
+        # (seq, frame) of whatever the tail holds past seq
+        tail = self._rooms.get(room_id)
+        if tail is None:
+            return []
+        return [(event_seq, frame) for event_seq, _, frame in tail.events if event_seq > seq]
+
+    def forget_message(self, room_id: int, message_id: int, keep_seq: int):
+        # Drops the events of a deleted message except the deletion itself
+        tail = self._rooms.get(room_id)
+        if tail is None:
+            return
+        kept = [event for event in tail.events if event[1] != message_id or event[0] == keep_seq]
+        if len(kept) != len(tail.events):
+            tail.events.clear()
+            tail.events.extend(kept)
+
+    def invalidate(self, room_id: int):
+        self._rooms.pop(room_id, None)
+
+def history_frame(frames: List[str], room_id: int, seq: Optional[int] = None, gap: bool = False) -> str:
+    # Frames are already JSON, join them without decoding. seq is the last event the
+    # history reflects, clients resume from it. gap tells a resuming client that its missed
+    # events could not be replayed, older messages have to be fetched over REST.
+    head = '{"type":"history","room_id":%d,' % room_id
+    if seq is not None:
+        head += '"seq":%d,' % seq
+    if gap:
+        head += '"gap":true,'
+    return head + '"messages":[' + ",".join(frames) + "]}"
+
+def replay_frame(frames: List[str], seq: int, room_id: int) -> str:
+    # Events a resuming client missed, in sequence order
+    return '{"type":"replay","room_id":%d,"seq":%d,"events":[%s]}' % (room_id, seq, ",".join(frames))
+
+# Global recent message and event cache instances
+recent_messages = RecentMessageCache()
+recent_events = RecentEventCache()
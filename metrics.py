@@ -0,0 +1,280 @@
+import bisect
+import os
+import random
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from dotenv import load_dotenv
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+# Load environment variables
+load_dotenv()
+
+# Fraction of HTTP requests whose timing is recorded (0 disables the middleware)
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0.1"))
+# Largest rooms exported with their own label, the rest only count towards the totals
+METRICS_TOP_ROOMS = int(os.getenv("METRICS_TOP_ROOMS", "10"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+# Minimal Prometheus metric types rendered in the text exposition format
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, values))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> Iterable[str]:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+# Counters and gauges either hold values or read them from a callback at scrape time.
+# The callback returns a number, or a {label value(s): number} dict for labelled metrics.
+class ValueMetric(Metric):
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        callback: Optional[Callable[[], object]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._callback = callback
+
+    def samples(self) -> Iterable[str]:
+        values = self._values
+        if self._callback is not None:
+            result = self._callback()
+            values = result if isinstance(result, dict) else {(): result}
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield f"{self.name}{self._format_labels(tuple(str(k) for k in key))} {value}"
+
+class Counter(ValueMetric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(ValueMetric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [per-bucket counts..., +Inf count], sum
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    def samples(self) -> Iterable[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{self._format_labels(key, ('le', repr(bound)))} {cumulative}"
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket{self._format_labels(key, ('le', '+Inf'))} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {total[0]}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+REGISTRY: List[Metric] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+# WebSocket fan-out
+BROADCAST_FANOUT_SECONDS = Histogram(
+    "chat_broadcast_fanout_seconds",
+    "Time to enqueue one event for every local member of a room"
+)
+BROADCAST_RECIPIENTS = Histogram(
+    "chat_broadcast_recipients",
+    "Local connections an event was fanned out to",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+)
+DROPPED_FRAMES = Counter(
+    "chat_dropped_frames_total",
+    "Outbound frames that were not delivered",
+    ["reason"]
+)
+SLOW_CONSUMER_DISCONNECTS = Counter(
+    "chat_slow_consumer_disconnects_total",
+    "Connections closed because their send queue was full"
+)
+FAILED_SENDS = Counter(
+    "chat_failed_sends_total",
+    "Socket writes that raised and closed the connection"
+)
+REAPED_CONNECTIONS = Counter(
+    "chat_reaped_connections_total",
+    "Connections closed because they stopped answering heartbeats"
+)
+SESSION_RESUMES = Counter(
+    "chat_session_resumes_total",
+    "Reconnects that asked for the events they missed, by whether a replay or the history was sent",
+    ["outcome"]
+)
+PRESENCE_RECLAIMED = Counter(
+    "chat_presence_reclaimed_total",
+    "Resumed connections that took over their presence inside the grace window"
+)
+
+RATE_LIMITED = Counter(
+    "chat_rate_limited_total",
+    "Requests and frames rejected by a rate limit",
+    ["limit"]
+)
+
+# Message ingestion
+MESSAGES_INGESTED = Counter("chat_messages_ingested_total", "Chat messages accepted for broadcast")
+MESSAGES_PERSISTED = Counter("chat_messages_persisted_total", "Chat messages written to the database")
+MESSAGE_FLUSH_SECONDS = Histogram("chat_message_flush_seconds", "Duration of one batched message INSERT")
+MESSAGE_FLUSH_FAILURES = Counter("chat_message_flush_failures_total", "Batched message INSERTs that failed")
+MESSAGES_ARCHIVED = Counter("chat_messages_archived_total", "Messages written to archive files and removed by retention")
+MAINTENANCE_FAILURES = Counter("chat_maintenance_failures_total", "Partition and retention maintenance runs that failed")
+
+# Database
+DB_QUERY_SECONDS = Histogram("chat_db_query_seconds", "SQL statement execution time", ["engine"])
+DB_POOL_CHECKOUTS = Counter(
+    "chat_db_pool_checkouts_total",
+    "Connections handed out by the database pool",
+    ["engine"]
+)
+DB_POOL_WAIT_SECONDS = Histogram(
+    "chat_db_pool_wait_seconds",
+    "Time a session waited for a pooled database connection, including opening a new one",
+    ["engine"]
+)
+DB_CONNECT_SECONDS = Histogram(
+    "chat_db_connect_seconds",
+    "Time to open a new database connection for the pool",
+    ["engine"]
+)
+
+# Authentication
+PASSWORD_SECONDS = Histogram(
+    "chat_password_seconds",
+    "bcrypt hash/verify time including time queued for a pool worker",
+    ["operation"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+# HTTP
+HTTP_REQUEST_SECONDS = Histogram(
+    "chat_http_request_seconds",
+    "Sampled HTTP request latency",
+    ["method", "route", "status"]
+)
+
+# Names of the instrumented engines, for the session events below
+_engine_names: Dict[Engine, str] = {}
+
+def instrument_engine(engine: Engine, name: str):
+    # Statement timings through cursor events, checkouts and new connections through pool events.
+    # A saturated pool shows as checked_out reaching its size in chat_db_pool_connections.
+    _engine_names[engine] = name
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if starts:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - starts.pop(), engine=name)
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKOUTS.inc(engine=name)
+
+    @event.listens_for(engine, "do_connect")
+    def on_do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["connect_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        started = connection_record.info.pop("connect_start", None)
+        if started is not None:
+            DB_CONNECT_SECONDS.observe(time.perf_counter() - started, engine=name)
+
+# Pools have no event before a checkout, so waits are timed from the session: from the
+# statement that starts a transaction to the transaction beginning on its connection
+@event.listens_for(Session, "do_orm_execute")
+def on_session_execute(orm_execute_state):
+    session = orm_execute_state.session
+    if not session.in_transaction():
+        session.info["checkout_start"] = time.perf_counter()
+
+@event.listens_for(Session, "after_begin")
+def on_session_begin(session, transaction, connection):
+    started = session.info.pop("checkout_start", None)
+    name = _engine_names.get(connection.engine)
+    if started is not None and name is not None:
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, engine=name)
+
+def checkout_requested(session: Session):
+    # Starts the wait for an explicit session.connection(), which runs no statement
+    session.info["checkout_start"] = time.perf_counter()
+
+async def sample_request_timing(request: Request, call_next):
+    # HTTP middleware, only a sample of requests pay for the bookkeeping
+    if random.random() >= METRICS_SAMPLE_RATE:
+        return await call_next(request)
+
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=getattr(route, "path", "unmatched"),
+        status=response.status_code
+    )
+    return response
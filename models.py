@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Text, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
@@ -28,16 +28,21 @@ class ChatRoom(Base):
     name = Column(String(100), nullable=False)
     description = Column(Text, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Days messages are kept before archival, NULL uses MESSAGE_RETENTION_DAYS and 0 keeps them forever
+    retention_days = Column(Integer, nullable=True)
     
-    # Relationship to messages
-    messages = relationship("Message", back_populates="room")
+    # Relationship to messages, deleted explicitly with the room (see delete_chat_room)
+    messages = relationship("Message", back_populates="room", passive_deletes=True)
 
 class Message(Base):
     __tablename__ = "messages"
     
-    id = Column(Integer, primary_key=True, index=True)
+    # Snowflake ids assigned by the ingestion pipeline, see ingestion.py
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, index=True)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+    # Set when the author edits the message
+    edited_at = Column(DateTime(timezone=True), nullable=True)
     
     # Foreign keys
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -46,3 +51,39 @@ class Message(Base):
     # Relationships
     user = relationship("User", back_populates="messages")
     room = relationship("ChatRoom", back_populates="messages")
+    
+    # Keyset pagination walks a room's history by id. On Postgres the table is partitioned
+    # by id range, which is a time range for snowflake ids (see retention.py).
+    __table_args__ = (
+        Index("ix_messages_room_id_id", "room_id", "id"),
+        {"postgresql_partition_by": "RANGE (id)"}
+    )
+
+class MessageReaction(Base):
+    __tablename__ = "message_reactions"
+    
+    # One row per user and emoji on a message. No foreign key to messages, which is
+    # partitioned; reactions are removed with their message (see events.py and retention.py).
+    message_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    emoji = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), nullable=False, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class RoomEvent(Base):
+    __tablename__ = "room_events"
+    
+    # Append-only log of everything broadcast to a room, numbered by a per-room sequence
+    # (see events.py). Clients resume from the last seq they saw.
+    room_id = Column(Integer, ForeignKey("chat_rooms.id"), primary_key=True)
+    seq = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=False)
+    type = Column(String(32), nullable=False)
+    message_id = Column(BigInteger().with_variant(Integer, "sqlite"), nullable=True)
+    # The broadcast frame. NULL for new messages, rebuilt from the messages table on replay,
+    # and cleared on the edits of a deleted message.
+    frame = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    __table_args__ = (
+        Index("ix_room_events_room_id_message_id", "room_id", "message_id"),
+    )
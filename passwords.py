@@ -0,0 +1,32 @@
+"""
+Password hashing helpers. Kept free of app imports so password pool worker
+processes only need passlib.
+"""
+import os
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+from passlib.context import CryptContext
+
+# Load environment variables
+load_dotenv()
+
+# bcrypt cost factor; hashes with a different cost are rehashed on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS
+)
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # Returns (valid, new_hash), new_hash is set when the stored hash uses an outdated cost
+    return pwd_context.verify_and_update(plain_password, hashed_password)
@@ -0,0 +1,179 @@
+import abc
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+
+from metrics import RATE_LIMITED
+
+# Load environment variables
+load_dotenv()
+
+# "memory://" limits per process, "redis://host:port/db" shares buckets across workers
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL", "memory://")
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() not in ("0", "false", "no", "off")
+# Buckets kept by the in-memory limiter, least recently used are forgotten (i.e. refilled)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# Default limits as "<count>/<period>", period in s, m or h with an optional multiplier
+# ("30/10s"). The count is also the burst. Override with RATE_LIMIT_<NAME>, "off" disables.
+DEFAULT_LIMITS = {
+    "login_ip": "20/m",
+    "login_user": "10/m",
+    "signup_ip": "10/m",
+    "ws_connect_ip": "60/m",
+    "ws_frame_connection": "50/10s",
+    "ws_message_user": "60/10s",
+    "ws_message_room": "500/s",
+    "ws_presence_sync_connection": "10/m",
+    "ws_subscribe_connection": "30/m"
+}
+
+PERIODS = {"s": 1, "m": 60, "h": 3600}
+
+class Limit:
+    def __init__(self, count: int, period: float):
+        self.burst = count
+        self.rate = count / period
+
+def parse_limit(spec: str) -> Optional[Limit]:
+    spec = spec.strip().lower()
+    if spec in ("", "off", "none", "0"):
+        return None
+    match = re.fullmatch(r"(\d+)\s*/\s*(\d*)\s*([smh])", spec)
+    if not match:
+        raise ValueError(f"Invalid rate limit {spec!r}, expected e.g. '10/s' or '30/10s'")
+    count, multiplier, unit = match.groups()
+    return Limit(int(count), int(multiplier or 1) * PERIODS[unit])
+
+def load_limits() -> Dict[str, Optional[Limit]]:
+    return {
+        name: parse_limit(os.getenv(f"RATE_LIMIT_{name.upper()}", spec))
+        for name, spec in DEFAULT_LIMITS.items()
+    }
+
+# Token buckets: each key starts with `burst` tokens, regains `rate` per second, and every hit
+# spends one. hit() returns 0 when allowed, otherwise the seconds until a token is available.
+class RateLimiter(abc.ABC):
+    def __init__(self, limits: Dict[str, Optional[Limit]]):
+        self.limits = limits
+
+    async def hit(self, name: str, key: Hashable, cost: float = 1) -> float:
+        limit = self.limits.get(name)
+        if limit is None or not RATE_LIMIT_ENABLED:
+            return 0.0
+        retry_after = await self._take(name, key, limit, cost)
+        if retry_after:
+            RATE_LIMITED.inc(limit=name)
+        return retry_after
+
+    @abc.abstractmethod
+    async def _take(self, name: str, key: Hashable, limit: Limit, cost: float) -> float:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class InMemoryRateLimiter(RateLimiter):
+    def __init__(self, limits: Dict[str, Optional[Limit]], max_keys: int = RATE_LIMIT_MAX_KEYS):
+        super().__init__(limits)
+        self.max_keys = max_keys
+        # (name, key) -> [tokens, updated_at]
+        self._buckets: "OrderedDict[Tuple[str, Hashable], List[float]]" = OrderedDict()
+
+    async def _take(self, name: str, key: Hashable, limit: Limit, cost: float) -> float:
+        now = time.monotonic()
+        bucket_key = (name, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = [float(limit.burst), now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / limit.rate
+
+# Buckets live in Redis hashes updated by a Lua script, so all workers share them
+class RedisRateLimiter(RateLimiter):
+    KEY_PREFIX = "chat:ratelimit:"
+
+    # KEYS: bucket. ARGV: rate, burst, cost. Uses the Redis clock so workers agree on time.
+    TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(retry_after)
+"""
+
+    def __init__(self, url: str, limits: Dict[str, Optional[Limit]]):
+        super().__init__(limits)
+        self.url = url
+        self._redis = None
+        self._script = None
+
+    async def _take(self, name: str, key: Hashable, limit: Limit, cost: float) -> float:
+        if self._redis is None:
+            # Imported lazily so the in-memory limiter works without redis installed
+            import redis.asyncio as redis
+
+            self._redis = redis.from_url(self.url, decode_responses=True)
+            self._script = self._redis.register_script(self.TAKE_SCRIPT)
+        try:
+            retry_after = await self._script(
+                keys=[f"{self.KEY_PREFIX}{name}:{key}"],
+                args=[limit.rate, limit.burst, cost]
+            )
+            return float(retry_after)
+        except Exception as e:
+            # Fail open, an unreachable Redis shouldn't lock everyone out
+            print(f"Rate limiter error: {e}")
+            return 0.0
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+def create_rate_limiter(url: str = RATE_LIMIT_URL) -> RateLimiter:
+    limits = load_limits()
+    if url.startswith("redis://") or url.startswith("rediss://"):
+        return RedisRateLimiter(url, limits)
+    return InMemoryRateLimiter(limits)
+
+# Global rate limiter instances. Connection-scoped limits never need to be shared,
+# so they always stay in memory.
+rate_limiter = create_rate_limiter()
+connection_rate_limiter = InMemoryRateLimiter(load_limits())
+
+async def enforce_rate_limit(name: str, key: Hashable):
+    # For HTTP routes, rejects with 429 before any database or password work
+    retry_after = await rate_limiter.hit(name, key)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, slow down",
+            headers={"Retry-After": str(max(1, round(retry_after)))},
+        )
@@ -0,0 +1,354 @@
+"""
+Time-partitioned message storage, retention and archival.
+
+On Postgres the messages table is range partitioned by id, one partition per month.
+Snowflake ids start with their creation time, so an id range is a time range: the
+primary key stays on id alone, and keyset history queries (room_id, id < cursor,
+newest first) only touch the partitions their range reaches. A maintenance task keeps
+PARTITION_MONTHS_AHEAD months of partitions ready and archives messages past their
+room's retention to gzipped JSONL files under ARCHIVE_DIR. A past partition whose rooms
+have all expired is written out, detached and dropped. Otherwise only the expired rows
+are written out and deleted. SQLite has no partitions and only uses the row path.
+Reactions and room event log entries of expired messages are deleted with them.
+Messages written before snowflake ids (below LEGACY_ID_LIMIT) don't carry their age in
+their id and expire by their timestamp instead.
+
+Run `python retention.py` for a single maintenance pass, e.g. from cron.
+"""
+import asyncio
+import gzip
+import os
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import and_, delete, exists, or_, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from database import add_column_if_missing, engine as default_engine
+from ingestion import LEGACY_ID_LIMIT, snowflake_floor, snowflake_time
+from metrics import MAINTENANCE_FAILURES, MESSAGES_ARCHIVED
+from models import ChatRoom, Message, MessageReaction, RoomEvent
+from serializers import dumps
+
+# Load environment variables
+load_dotenv()
+
+# Days messages are kept for rooms without their own policy, 0 keeps them forever
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "0"))
+# Future monthly partitions kept ready, messages without a partition can't be written
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Seconds between maintenance passes, 0 leaves maintenance to `python retention.py`
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+# Rows written per archive file and deleted per transaction by the row path
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+# Postgres advisory lock so only one worker runs maintenance at a time
+MAINTENANCE_LOCK_ID = 0x63686174
+
+LEGACY_PARTITION = "messages_p_legacy"
+
+class Partition(NamedTuple):
+    name: str
+    # Id bounds, lower inclusive and upper exclusive, None for MINVALUE/MAXVALUE
+    lower: Optional[int]
+    upper: Optional[int]
+
+def month_start(when: datetime) -> datetime:
+    return when.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(month: datetime, count: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+def retention_days(room: ChatRoom) -> int:
+    return MESSAGE_RETENTION_DAYS if room.retention_days is None else room.retention_days
+
+def retention_floor(room: ChatRoom, now: Optional[datetime] = None) -> Optional[int]:
+    # Smallest message id still within the room's retention, None when kept forever.
+    # History queries filter on it so expired messages vanish before the archiver
+    # gets to them and Postgres can prune partitions below it.
+    days = retention_days(room)
+    if days <= 0:
+        return None
+    return snowflake_floor((now or datetime.now(timezone.utc)) - timedelta(days=days))
+
+def retained(min_id: int):
+    # Condition for messages within retention given retention_floor(), or more generally
+    # written at or after snowflake_time(min_id), and expired() its opposite. Snowflake ids
+    # are compared directly, which keeps partition pruning; legacy ids go by their timestamp.
+    return or_(
+        Message.id >= min_id,
+        and_(Message.id < LEGACY_ID_LIMIT, Message.timestamp >= snowflake_time(min_id))
+    )
+
+def expired(min_id: int):
+    return and_(
+        Message.id < min_id,
+        or_(Message.id >= LEGACY_ID_LIMIT, Message.timestamp < snowflake_time(min_id))
+    )
+
+def expired_id(message_id: int, min_id: Optional[int]) -> bool:
+    # Only snowflake ids can be judged without their row, legacy ones count as retained
+    return min_id is not None and LEGACY_ID_LIMIT <= message_id < min_id
+
+def setup_retention(engine: Engine):
+    add_column_if_missing(engine, "chat_rooms", "retention_days", "INTEGER")
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            ensure_partitions(conn)
+
+def is_partitioned(conn: Connection) -> bool:
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass)"
+    )).scalar()
+
+def parse_bound(value: str) -> Optional[int]:
+    value = value.strip("'")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+def list_partitions(conn: Connection) -> List[Partition]:
+    result = conn.execute(text("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """))
+    partitions = []
+    for row in result:
+        # e.g. FOR VALUES FROM (MINVALUE) TO ('123'), a DEFAULT partition has no range
+        match = re.search(r"FROM \(([^)]+)\) TO \(([^)]+)\)", row.bound)
+        if match:
+            partitions.append(Partition(row.name, parse_bound(match.group(1)), parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda partition: (partition.lower is not None, partition.lower or 0))
+
+def create_partition(conn: Connection, name: str, lower: Optional[int], upper: int):
+    start = "MINVALUE" if lower is None else str(lower)
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES FROM ({start}) TO ({upper})"))
+
+def ensure_partitions(conn: Connection, now: Optional[datetime] = None) -> List[str]:
+    # Creates monthly partitions up to PARTITION_MONTHS_AHEAD, filling any gap since the last one
+    if not is_partitioned(conn):
+        print("messages is not partitioned (created before partitioning), skipping partition maintenance")
+        return []
+
+    current = month_start(now or datetime.now(timezone.utc))
+    partitions = list_partitions(conn)
+    if any(partition.upper is None for partition in partitions):
+        return []
+
+    created = []
+    if partitions:
+        month = month_start(snowflake_time(max(partition.upper for partition in partitions)))
+    else:
+        # Everything before the first month, including ids from before snowflakes
+        create_partition(conn, LEGACY_PARTITION, None, snowflake_floor(current))
+        created.append(LEGACY_PARTITION)
+        month = current
+
+    last = add_months(current, PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        name = f"messages_p{month:%Y%m}"
+        create_partition(conn, name, snowflake_floor(month), snowflake_floor(add_months(month, 1)))
+        created.append(name)
+        month = add_months(month, 1)
+    return created
+
+def write_archive(path: str, rows: Iterable) -> Tuple[int, Optional[int], Optional[int]]:
+    # Writes rows as gzipped JSONL, returns (count, first id, last id). The file is
+    # synced and renamed into place before the caller deletes anything.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    count, first_id, last_id = 0, None, None
+    with open(temp_path, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for row in rows:
+                archive.write((dumps({
+                    "id": row.id,
+                    "room_id": row.room_id,
+                    "user_id": row.user_id,
+                    "content": row.content,
+                    "timestamp": row.timestamp.isoformat() if row.timestamp else None
+                }) + "\n").encode())
+                if first_id is None:
+                    first_id = row.id
+                last_id = row.id
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    if count:
+        os.replace(temp_path, path)
+    else:
+        os.remove(temp_path)
+    return count, first_id, last_id
+
+def archive_columns():
+    return (Message.id, Message.room_id, Message.user_id, Message.content, Message.timestamp)
+
+def room_floors(conn: Connection, now: datetime) -> Dict[int, Optional[int]]:
+    rooms = conn.execute(select(ChatRoom.id, ChatRoom.retention_days)).all()
+    return {room.id: retention_floor(room, now) for room in rooms}
+
+def archive_partitions(engine: Engine, floors: Dict[int, Optional[int]], now: datetime) -> List[str]:
+    # Whole past partitions where every room's messages have expired
+    if all(floor is None for floor in floors.values()):
+        return []
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            return []
+        partitions = list_partitions(conn)
+
+    current = snowflake_floor(month_start(now))
+    archived = []
+    for partition in partitions:
+        if partition.upper is None or partition.upper > current:
+            continue
+        # Legacy ids carry no time, their rows expire one by one on the row path
+        if partition.lower is None or partition.lower < LEGACY_ID_LIMIT:
+            continue
+        # Rooms that keep some of the partition's range, probed through the (room_id, id) index
+        keeping = [room_id for room_id, floor in floors.items() if floor is None or floor < partition.upper]
+        with engine.connect() as conn:
+            blocked = conn.execute(
+                text(f"SELECT EXISTS (SELECT 1 FROM {partition.name} WHERE room_id = ANY(:rooms))"),
+                {"rooms": keeping}
+            ).scalar()
+            # Empty partitions are left alone, late writes may still land in them
+            empty = not conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {partition.name})")).scalar()
+        if blocked or empty:
+            continue
+
+        with engine.connect() as conn:
+            rows = conn.execution_options(yield_per=ARCHIVE_BATCH_SIZE).execute(text(
+                f"SELECT id, room_id, user_id, content, timestamp FROM {partition.name} ORDER BY id"
+            ))
+            path = os.path.join(ARCHIVE_DIR, f"{partition.name}.jsonl.gz")
+            count, _, _ = write_archive(path, rows)
+
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {partition.name}"))
+            conn.execute(text(f"DROP TABLE {partition.name}"))
+        MESSAGES_ARCHIVED.inc(count)
+        archived.append(partition.name)
+        print(f"Archived partition {partition.name} ({count} messages) to {path}")
+    return archived
+
+def archive_rows(engine: Engine, floors: Dict[int, Optional[int]]) -> int:
+    # Expired messages of rooms whose partitions are still shared with newer data, one
+    # file of up to ARCHIVE_BATCH_SIZE rows at a time
+    archived = 0
+    for room_id, floor in floors.items():
+        if floor is None:
+            continue
+        after_id = None
+        while True:
+            query = (
+                select(*archive_columns())
+                .where(Message.room_id == room_id, expired(floor))
+                .order_by(Message.id)
+                .limit(ARCHIVE_BATCH_SIZE)
+            )
+            if after_id is not None:
+                query = query.where(Message.id > after_id)
+            with engine.connect() as conn:
+                rows = conn.execute(query).all()
+            pending_path = os.path.join(ARCHIVE_DIR, f"room_{room_id}", "pending.jsonl.gz")
+            count, first_id, last_id = write_archive(pending_path, rows)
+            if not count:
+                break
+            path = os.path.join(ARCHIVE_DIR, f"room_{room_id}", f"{first_id}-{last_id}.jsonl.gz")
+            os.replace(pending_path, path)
+
+            # Exactly the rows in the file, not whatever else sits in their id range
+            with engine.begin() as conn:
+                conn.execute(delete(Message).where(Message.id.in_([row.id for row in rows])))
+            archived += count
+            MESSAGES_ARCHIVED.inc(count)
+            after_id = last_id
+            print(f"Archived messages {first_id}-{last_id} of room {room_id} to {path}")
+    return archived
+
+def prune_message_state(engine: Engine, floors: Dict[int, Optional[int]]) -> int:
+    # Reactions and logged events of archived messages, whichever path archived them.
+    # Returns the number of events removed.
+    pruned = 0
+    for room_id, floor in floors.items():
+        if floor is None:
+            continue
+        with engine.begin() as conn:
+            conn.execute(
+                delete(MessageReaction)
+                .where(
+                    MessageReaction.room_id == room_id,
+                    MessageReaction.message_id < floor,
+                    ~exists().where(Message.id == MessageReaction.message_id)
+                )
+            )
+            pruned += conn.execute(
+                delete(RoomEvent)
+                .where(
+                    RoomEvent.room_id == room_id,
+                    RoomEvent.message_id < floor,
+                    ~exists().where(Message.id == RoomEvent.message_id)
+                )
+            ).rowcount
+    return pruned
+
+def run_maintenance(engine: Engine = default_engine, now: Optional[datetime] = None) -> dict:
+    # One pass: create upcoming partitions, then archive what is past retention
+    now = now or datetime.now(timezone.utc)
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as lock:
+        if postgres and not lock.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": MAINTENANCE_LOCK_ID}).scalar():
+            return {"skipped": True}
+        try:
+            created = []
+            if postgres:
+                with engine.begin() as conn:
+                    created = ensure_partitions(conn, now)
+            with engine.connect() as conn:
+                floors = room_floors(conn, now)
+            partitions = archive_partitions(engine, floors, now) if postgres else []
+            archived = archive_rows(engine, floors)
+            return {
+                "partitions_created": created,
+                "partitions_archived": partitions,
+                "messages_archived": archived,
+                "events_pruned": prune_message_state(engine, floors)
+            }
+        finally:
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MAINTENANCE_LOCK_ID})
+
+# Runs run_maintenance every MAINTENANCE_INTERVAL seconds in a thread, off the event loop
+class MaintenanceTask:
+    def __init__(self, engine: Engine = default_engine, interval: float = MAINTENANCE_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # Startup already created this month's partitions
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(run_maintenance, self.engine)
+            except Exception as e:
+                MAINTENANCE_FAILURES.inc()
+                print(f"Maintenance error: {e}")
+
+# Global maintenance task instance
+maintenance = MaintenanceTask()
+
+if __name__ == "__main__":
+    print(run_maintenance())
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field
+from typing import Dict, Optional, List
 from datetime import datetime
 from models import UserRole
 
@@ -37,10 +37,15 @@ class TokenData(BaseModel):
 class ChatRoomBase(BaseModel):
     name: str
     description: Optional[str] = None
+    # Days messages are kept, None uses the server default and 0 keeps them forever
+    retention_days: Optional[int] = Field(None, ge=0)
 
 class ChatRoomCreate(ChatRoomBase):
     pass
 
+class RetentionPolicy(BaseModel):
+    retention_days: Optional[int] = Field(None, ge=0)
+
 class ChatRoomResponse(ChatRoomBase):
     id: int
     created_at: datetime
@@ -65,6 +70,38 @@ class MessageResponse(MessageBase):
     class Config:
         from_attributes = True
 
+# Slim shapes for history and search, the author is embedded as id and username only
+class MessageAuthor(BaseModel):
+    id: int
+    username: str
+
+class MessageSummary(MessageBase):
+    id: int
+    timestamp: datetime
+    edited_at: Optional[datetime] = None
+    user_id: int
+    room_id: int
+    user: MessageAuthor
+    # Reaction counts by emoji, filled in history pages
+    reactions: Dict[str, int] = {}
+
+class MessagePage(BaseModel):
+    # Newest first; pass before_id for older messages, after_id for newer ones
+    messages: List[MessageSummary]
+    before_id: Optional[int] = None
+    after_id: Optional[int] = None
+
+class SearchResult(BaseModel):
+    message: MessageSummary
+    # Message content with matches wrapped in <mark></mark>
+    highlight: str
+    score: float
+
+class SearchPage(BaseModel):
+    # Best matches first; pass next_cursor as cursor for the following page
+    results: List[SearchResult]
+    next_cursor: Optional[str] = None
+
 class WebSocketMessage(BaseModel):
     content: str
     room_id: int
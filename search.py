@@ -0,0 +1,165 @@
+"""
+Full-text search over chat messages.
+
+Postgres gets a generated tsvector column with a GIN index on (room_id, search_vector),
+SQLite an external-content FTS5 table kept in sync by triggers. Both are created by
+setup_search() at startup, so rows written by any path (including batched inserts) are
+indexed without app code. Matches are ranked first and only the page returned gets its
+highlight, which is the expensive part.
+"""
+import base64
+import os
+import re
+from typing import List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ingestion import LEGACY_ID_LIMIT, snowflake_time
+
+# Load environment variables
+load_dotenv()
+
+# Text search configuration used for the Postgres tsvector ("english" stems words, "simple" doesn't)
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "english")
+if not re.fullmatch(r"\w+", SEARCH_LANGUAGE):
+    raise ValueError(f"Invalid SEARCH_LANGUAGE {SEARCH_LANGUAGE!r}")
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+# (message_id, score, highlight), best matches first
+SearchHit = Tuple[int, float, str]
+
+POSTGRES_DDL = [
+    f"""
+    ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', content)) STORED
+    """,
+    # btree_gin lets one GIN index take the room too, so a search reads only that room's entries
+    "CREATE EXTENSION IF NOT EXISTS btree_gin",
+    "CREATE INDEX IF NOT EXISTS ix_messages_room_search ON messages USING GIN (room_id, search_vector)",
+    "DROP INDEX IF EXISTS ix_messages_search_vector"
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id')",
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # Index messages written before search existed
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"
+]
+
+def setup_search(engine: Engine):
+    # Postgres DDL guards itself with IF [NOT] EXISTS, SQLite's only runs without the FTS table
+    dialect = engine.dialect.name
+    if dialect == "postgresql":
+        statements = POSTGRES_DDL
+    elif dialect == "sqlite":
+        if inspect(engine).has_table("messages_fts"):
+            return
+        statements = SQLITE_DDL
+    else:
+        return
+
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+def encode_cursor(score: float, message_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{score!r}:{message_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    score, message_id = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+    return float(score), int(message_id)
+
+def fts5_query(query: str) -> str:
+    # Every word must match; quoting keeps FTS5 operators in user input from being interpreted
+    terms = re.findall(r"\w+", query)
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+async def search_messages(
+    db: AsyncSession,
+    room_id: int,
+    query: str,
+    limit: int,
+    after: Optional[Tuple[float, int]] = None,
+    min_id: Optional[int] = None
+) -> List[SearchHit]:
+    # Keyset pagination on (score, id), both descending. min_id hides messages past retention,
+    # messages from before snowflake ids by their timestamp (see retention.retained).
+    score, message_id = after or (0.0, 0)
+    retention = "" if min_id is None else (
+        "AND (m.id >= :min_id OR (m.id < :legacy_id AND m.timestamp >= :min_time))"
+    )
+    if db.bind.dialect.name == "postgresql":
+        statement = text(f"""
+            WITH q AS (SELECT websearch_to_tsquery('{SEARCH_LANGUAGE}', :query) AS query),
+            page AS (
+                SELECT id, score FROM (
+                    SELECT m.id AS id, ts_rank(m.search_vector, q.query) AS score
+                    FROM messages m, q
+                    WHERE m.room_id = :room_id AND m.search_vector @@ q.query {retention}
+                ) hits
+                WHERE :first_page OR score < :score OR (score = :score AND id < :message_id)
+                ORDER BY score DESC, id DESC
+                LIMIT :limit
+            )
+            SELECT page.id, page.score,
+                   ts_headline('{SEARCH_LANGUAGE}', m.content, q.query,
+                               'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}') AS highlight
+            FROM page JOIN messages m ON m.id = page.id, q
+            ORDER BY page.score DESC, page.id DESC
+        """)
+        params = {"query": query}
+    else:
+        match = fts5_query(query)
+        if not match:
+            return []
+        # bm25() is lower for better matches, negated so both backends sort the same way
+        statement = text(f"""
+            WITH page AS (
+                SELECT id, score FROM (
+                    SELECT m.id AS id, -bm25(messages_fts) AS score
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH :query AND m.room_id = :room_id {retention}
+                ) hits
+                WHERE :first_page OR score < :score OR (score = :score AND id < :message_id)
+                ORDER BY score DESC, id DESC
+                LIMIT :limit
+            )
+            SELECT page.id, page.score,
+                   highlight(messages_fts, 0, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}') AS highlight
+            FROM page JOIN messages_fts ON messages_fts.rowid = page.id
+            WHERE messages_fts MATCH :query
+            ORDER BY page.score DESC, page.id DESC
+        """)
+        params = {"query": match}
+
+    params.update({
+        "room_id": room_id,
+        "first_page": after is None,
+        "score": score,
+        "message_id": message_id,
+        "limit": limit
+    })
+    if min_id is not None:
+        params.update({"min_id": min_id, "legacy_id": LEGACY_ID_LIMIT, "min_time": snowflake_time(min_id)})
+    result = await db.execute(statement, params)
+    return [(row.id, row.score, row.highlight) for row in result]
@@ -0,0 +1,101 @@
+import abc
+import json
+from typing import Any, Dict, List, Optional, Union
+from fastapi import Response, WebSocket
+
+try:
+    import orjson
+except ImportError:
+    # Falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    # The binary subprotocol is then not offered
+    msgpack = None
+
+# Outbound frame as handed to the socket, text for JSON and bytes for binary formats
+Frame = Union[str, bytes]
+
+def dumps(obj: Any) -> str:
+    # Canonical JSON encoding, used for the backplane, the recent message cache and JSON clients
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, default=str, separators=(",", ":"))
+
+def loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_response(obj: Any, status_code: int = 200) -> Response:
+    # Fast path for large read responses: plain dicts encoded in one pass, skipping
+    # per-row Pydantic models. The route's response_model still documents the shape.
+    return Response(content=dumps(obj), status_code=status_code, media_type="application/json")
+
+# A wire format a client can speak. Events are serialized once to canonical JSON,
+# other formats are derived from that frame once per event and shared by every recipient.
+class WireFormat(abc.ABC):
+    name = ""
+    subprotocol: Optional[str] = None
+    binary = False
+
+    @abc.abstractmethod
+    def encode(self, obj: Any) -> Frame:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def decode(self, data: Frame) -> Any:
+        raise NotImplementedError
+
+    def from_json(self, frame: str) -> Frame:
+        return self.encode(loads(frame))
+
+class JsonFormat(WireFormat):
+    name = "json"
+
+    def encode(self, obj: Any) -> Frame:
+        return dumps(obj)
+
+    def decode(self, data: Frame) -> Any:
+        return loads(data)
+
+    def from_json(self, frame: str) -> Frame:
+        return frame
+
+class MsgpackFormat(WireFormat):
+    name = "msgpack"
+    subprotocol = "chat.msgpack"
+    binary = True
+
+    def encode(self, obj: Any) -> Frame:
+        return msgpack.packb(obj, default=str)
+
+    def decode(self, data: Frame) -> Any:
+        if isinstance(data, str):
+            return loads(data)
+        return msgpack.unpackb(data)
+
+JSON_FORMAT = JsonFormat()
+MSGPACK_FORMAT = MsgpackFormat()
+
+# Formats offered through the Sec-WebSocket-Protocol header, in order of preference
+WIRE_FORMATS: Dict[str, WireFormat] = {}
+if msgpack is not None:
+    WIRE_FORMATS[MSGPACK_FORMAT.subprotocol] = MSGPACK_FORMAT
+
+def negotiate_format(websocket: WebSocket) -> WireFormat:
+    # Clients that ask for no (or no known) subprotocol get JSON text frames
+    requested: List[str] = websocket.scope.get("subprotocols") or []
+    for subprotocol in requested:
+        wire_format = WIRE_FORMATS.get(subprotocol)
+        if wire_format is not None:
+            return wire_format
+    return JSON_FORMAT
+
+def decode_frame(wire_format: WireFormat, message: dict) -> Any:
+    # Decodes a raw "websocket.receive" ASGI message, either format may arrive as text
+    if message.get("bytes") is not None:
+        return wire_format.decode(message["bytes"])
+    return loads(message["text"])
@@ -1,82 +1,638 @@
-from typing import Dict, List, Set
-from fastapi import WebSocket
-import json
+import asyncio
+import heapq
+import itertools
+import os
+import sys
+import time
+from collections import deque
 from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Set, Tuple
+from fastapi import WebSocket
+
+from backplane import Backplane, NODE_ID, SequenceFloor, create_backplane
+from message_cache import MESSAGE_UPDATE_TYPES, recent_events, recent_messages
+from serializers import JSON_FORMAT, Frame, WireFormat, dumps
+from metrics import (
+    BROADCAST_FANOUT_SECONDS,
+    BROADCAST_RECIPIENTS,
+    DROPPED_FRAMES,
+    FAILED_SENDS,
+    METRICS_TOP_ROOMS,
+    PRESENCE_RECLAIMED,
+    REAPED_CONNECTIONS,
+    SLOW_CONSUMER_DISCONNECTS,
+    Gauge
+)
+
+# Maximum number of frames buffered per connection before the slow consumer policy kicks in
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# Slow consumer policy: "drop_oldest", "coalesce" or "disconnect"
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+
+# Seconds between server pings (0 disables heartbeats), and the silence after which
+# a connection is considered dead and reaped. Any inbound frame counts as a sign of life.
+HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "30"))
+HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "75"))
+
+PING = {"type": "ping"}
+
+# Presence changes within this window are published as one delta per room
+PRESENCE_COALESCE_MS = int(os.getenv("PRESENCE_COALESCE_MS", "250"))
+
+# Seconds a dropped connection stays present, so reconnecting within it (e.g. during a
+# rolling deploy) publishes no leave and join. 0 removes presence right away.
+RESUME_GRACE_SECONDS = float(os.getenv("WS_RESUME_GRACE_SECONDS", "10"))
+# How often expired departures are looked for. Without a grace period the only departures
+# are the connections of crashed workers, found by the backplane's heartbeat.
+DEPARTURE_SWEEP_INTERVAL = max(0.5, RESUME_GRACE_SECONDS / 4) if RESUME_GRACE_SECONDS > 0 else 5.0
+
+# Frame types dropped first when a queue is full, clients recover them with a presence_sync
+COALESCABLE_TYPES = {"presence_delta"}
+
+# Members per room shard. Rooms larger than one shard are fanned out a shard at a time,
+# giving other tasks the event loop in between.
+ROOM_SHARD_SIZE = int(os.getenv("WS_ROOM_SHARD_SIZE", "1024"))
+
+# Presence member ids, unique per connection within this process
+_member_ids = itertools.count(1)
+
+# Bounded outbound queue for one connection. Its writer task is started by the first frame
+# and then sleeps on an event between bursts, so queueing a frame during a broadcast is an
+# append and at most one wakeup, never a task spawn.
+class SendQueue:
+    __slots__ = (
+        "websocket", "maxsize", "policy", "wire_format", "frames", "deltas", "dropped",
+        "_on_error", "_ready", "_task"
+    )
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        on_error: Callable[[WebSocket], Awaitable[None]],
+        maxsize: int = SEND_QUEUE_SIZE,
+        policy: str = SLOW_CONSUMER_POLICY,
+        wire_format: WireFormat = JSON_FORMAT
+    ):
+        self.websocket = websocket
+        self.maxsize = maxsize
+        self.policy = policy
+        self.wire_format = wire_format
+        self.frames: Optional[Deque[Frame]] = deque()
+        # With the "coalesce" policy, coalescable frames wait here and are sent after the
+        # others, so a full queue drops the oldest of them without searching for it.
+        # Clients ignore presence deltas older than the version they hold.
+        self.deltas: Optional[Deque[Frame]] = None
+        self.dropped = 0
+        self._on_error = on_error
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def depth(self) -> int:
+        return (len(self.frames) if self.frames else 0) + (len(self.deltas) if self.deltas else 0)
+
+    def put(self, frame: Frame, kind: Optional[str] = None) -> bool:
+        # Returns False when the consumer is too slow and should be disconnected
+        if self.frames is None:
+            # Closed
+            return True
+        if self.depth() >= self.maxsize:
+            if self.policy == "disconnect":
+                return False
+            # Coalescable frames go first, deltas is only ever filled under "coalesce"
+            (self.deltas or self.frames).popleft()
+            self.dropped += 1
+            DROPPED_FRAMES.inc(reason="queue_full")
+
+        if self.policy == "coalesce" and kind in COALESCABLE_TYPES:
+            if self.deltas is None:
+                self.deltas = deque()
+            self.deltas.append(frame)
+        else:
+            self.frames.append(frame)
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+        elif not self._ready.is_set():
+            self._ready.set()
+        return True
+
+    def close(self):
+        self.frames = self.deltas = None
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def _writer(self):
+        try:
+            while self.frames is not None:
+                while self.frames or self.deltas:
+                    frame = (self.frames or self.deltas).popleft()
+                    if isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+                # Drained, sleep until the next put
+                self._ready.clear()
+                await self._ready.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Connection is closed, let the manager clean it up
+            FAILED_SENDS.inc()
+            await self._on_error(self.websocket)
+
+# State of one local connection, slotted since a pod holds one per open WebSocket
+class Connection:
+    __slots__ = ("websocket", "user_id", "username", "key", "last_seen", "send_queue", "subscriptions")
+
+    def __init__(self, websocket: WebSocket, user_id: int, username: str, key: str, send_queue: SendQueue):
+        self.websocket = websocket
+        self.user_id = user_id
+        # Interned, every connection of a user shares one string
+        self.username = sys.intern(username)
+        # Unique within this process, keys the connection's rate limits
+        self.key = key
+        self.last_seen = time.monotonic()
+        # None once the connection is being dropped, nothing more is queued
+        self.send_queue: Optional[SendQueue] = send_queue
+        # Rooms the connection receives events of, by room_id
+        self.subscriptions: Dict[int, "Subscription"] = {}
+
+# Membership of one connection in one room. Connections to /ws/{room_id} have one,
+# multiplexed connections one per subscribed room.
+class Subscription:
+    __slots__ = ("connection", "room_id", "member_id", "shard", "pending")
+
+    def __init__(self, connection: Connection, room_id: int, member_id: str):
+        self.connection = connection
+        self.room_id = room_id
+        # The room's presence entry for this subscription
+        self.member_id = member_id
+        # Index of the room shard holding this subscription
+        self.shard = 0
+        # Room events held back while the join frames are prepared, None once released
+        self.pending: Optional[List[Tuple[Optional[str], Frame]]] = []
+
+# Local subscriptions of one room, in shards of at most ROOM_SHARD_SIZE. Each subscription
+# knows its shard, so removal is O(1), and fan-out walks the shards in place instead of
+# copying the membership.
+class RoomMembers:
+    __slots__ = ("shards", "count", "lock")
 
-class ConnectionManager:
     def __init__(self):
-        # Store active connections by room_id
-        self.active_connections: Dict[int, Set[WebSocket]] = {}
-        # Store user info for each connection
-        self.connection_users: Dict[WebSocket, dict] = {}
-    
-    async def connect(self, websocket: WebSocket, room_id: int, user_info: dict):
-        await websocket.accept()
-        
+        self.shards: List[Set[Subscription]] = []
+        self.count = 0
+        # Keeps sharded fan-outs of the room in event order, created on first use
+        self.lock: Optional[asyncio.Lock] = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Subscription]:
+        for shard in self.shards:
+            yield from shard
+
+    def add(self, subscription: Subscription):
+        for index, shard in enumerate(self.shards):
+            if len(shard) < ROOM_SHARD_SIZE:
+                break
+        else:
+            index, shard = len(self.shards), set()
+            self.shards.append(shard)
+        shard.add(subscription)
+        subscription.shard = index
+        self.count += 1
+
+    def discard(self, subscription: Subscription):
+        shard = self.shards[subscription.shard]
+        if subscription in shard:
+            shard.remove(subscription)
+            self.count -= 1
+
+class ConnectionManager:
+    def __init__(self, backplane: Optional[Backplane] = None):
+        # Local members of each room by room_id
+        self.rooms: Dict[int, RoomMembers] = {}
+        # State of each local connection
+        self.connections: Dict[WebSocket, Connection] = {}
+        # Room events and presence are routed through the backplane so rooms span workers
+        self.backplane = backplane or create_backplane()
+        self.backplane.set_handler(self._deliver_local)
+        # Users whose presence changed since the room's last delta, flushed after PRESENCE_COALESCE_MS
+        self._presence_changes: Dict[int, Dict[int, dict]] = {}
+        self._presence_flushes: Dict[int, asyncio.Task] = {}
+        # Last presence snapshot frame per room, reused by joins until the version moves
+        self._presence_snapshots: Dict[int, Tuple[int, str]] = {}
+        # Sends pings and reaps silent connections
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Removes the presence of dropped connections that didn't come back in time
+        self._departures_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.backplane.start()
+        if HEARTBEAT_INTERVAL > 0 and self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        if self._departures_task is None:
+            self._departures_task = asyncio.create_task(self._sweep_departures())
+
+    async def stop(self):
+        for task in (self._heartbeat_task, self._departures_task):
+            if task:
+                task.cancel()
+        self._heartbeat_task = None
+        self._departures_task = None
+
+        # Ask clients to reconnect (to another worker) and keep their presence for the grace
+        # period, the departures are removed by whichever worker is running by then
+        for websocket in list(self.connections):
+            await self._close_connection(websocket, 1012, "Server restart")
+        for task in list(self._presence_flushes.values()):
+            task.cancel()
+        for room_id in list(self._presence_changes):
+            await self._flush_presence(room_id)
+        await self.backplane.stop()
+
+    async def accept(self, websocket: WebSocket, user_info: dict, wire_format: WireFormat = JSON_FORMAT) -> Connection:
+        # Accepts the socket without joining a room, see subscribe()
+        await websocket.accept(subprotocol=wire_format.subprotocol)
+        connection = Connection(
+            websocket,
+            user_info["user_id"],
+            user_info["username"],
+            f"{NODE_ID}:{next(_member_ids)}",
+            SendQueue(websocket, self.disconnect, wire_format=wire_format)
+        )
+        self.connections[websocket] = connection
+        return connection
+
+    async def subscribe(self, websocket: WebSocket, room_id: int, member_id: Optional[str] = None) -> str:
+        # Joins an accepted connection to a room. Room events are held back until release(),
+        # so the caller can send the join frames (history or replay) ahead of them. A resumed
+        # subscription passes the member_id it had and takes over its presence if that is
+        # still inside the grace period. Returns the subscription's member_id.
+        connection = self.connections[websocket]
+        subscription = connection.subscriptions.get(room_id)
+        if subscription is not None:
+            return subscription.member_id
+
         # Add room if it doesn't exist
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = set()
-        
-        # Add connection to room
-        self.active_connections[room_id].add(websocket)
-        self.connection_users[websocket] = {
-            "user_id": user_info["user_id"],
-            "username": user_info["username"],
-            "room_id": room_id
-        }
-        
-        print(f"User {user_info['username']} connected to room {room_id}")
-    
-    def disconnect(self, websocket: WebSocket):
-        # Find and remove the connection
-        user_info = self.connection_users.get(websocket)
-        if user_info:
-            room_id = user_info["room_id"]
-            if room_id in self.active_connections:
-                self.active_connections[room_id].discard(websocket)
-                
-                # Remove empty room
-                if not self.active_connections[room_id]:
-                    del self.active_connections[room_id]
-            
-            del self.connection_users[websocket]
-            print(f"User {user_info['username']} disconnected from room {room_id}")
-    
+        members = self.rooms.get(room_id)
+        if members is None:
+            members = self.rooms[room_id] = RoomMembers()
+            await self.backplane.subscribe(room_id)
+
+        presence_info = {"user_id": connection.user_id, "username": connection.username}
+        reclaimed = (
+            member_id is not None
+            and RESUME_GRACE_SECONDS > 0
+            and await self.backplane.reclaim_presence(room_id, member_id, presence_info)
+        )
+        if reclaimed:
+            PRESENCE_RECLAIMED.inc()
+        else:
+            member_id = f"{NODE_ID}:{next(_member_ids)}"
+
+        # Add subscription to room
+        subscription = Subscription(connection, room_id, member_id)
+        members.add(subscription)
+        connection.subscriptions[room_id] = subscription
+
+        if not reclaimed and await self.backplane.add_presence(room_id, member_id, presence_info):
+            self._presence_changed(room_id, presence_info)
+
+        print(f"User {connection.username} connected to room {room_id}")
+        return member_id
+
+    def release(self, websocket: WebSocket, room_id: int):
+        # Sends the room events held back since subscribe(), after everything sent meanwhile
+        connection = self.connections.get(websocket)
+        subscription = connection.subscriptions.get(room_id) if connection else None
+        if subscription is None or subscription.pending is None:
+            return
+        pending, subscription.pending = subscription.pending, None
+        send_queue = connection.send_queue
+        for kind, frame in pending:
+            if send_queue and not send_queue.put(frame, kind):
+                self._drop_slow_consumer(websocket)
+                return
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        room_id: int,
+        user_info: dict,
+        wire_format: WireFormat = JSON_FORMAT,
+        member_id: Optional[str] = None
+    ) -> str:
+        # One connection in one room, receiving room events right away
+        await self.accept(websocket, user_info, wire_format)
+        member_id = await self.subscribe(websocket, room_id, member_id)
+        self.release(websocket, room_id)
+        return member_id
+
+    async def unsubscribe(self, websocket: WebSocket, room_id: int) -> bool:
+        # Leaves one room and its presence right away, False when not subscribed
+        connection = self.connections.get(websocket)
+        subscription = connection.subscriptions.pop(room_id, None) if connection else None
+        if subscription is None:
+            return False
+        await self._leave(subscription, resumable=False)
+        return True
+
+    async def disconnect(self, websocket: WebSocket, resumable: bool = True):
+        # Connections that went away without saying goodbye (resumable) keep their presence
+        # for RESUME_GRACE_SECONDS, a client closing normally leaves right away
+        connection = self.connections.pop(websocket, None)
+        if connection is None:
+            return
+
+        # Stop the writer task, pending frames are discarded
+        if connection.send_queue:
+            connection.send_queue.close()
+            connection.send_queue = None
+
+        for subscription in list(connection.subscriptions.values()):
+            await self._leave(subscription, resumable)
+
+    async def _leave(self, subscription: Subscription, resumable: bool):
+        # Remove the subscription from its room
+        room_id = subscription.room_id
+        members = self.rooms.get(room_id)
+        if members is not None:
+            members.discard(subscription)
+
+            # Remove empty room, its recent messages would go stale once unsubscribed
+            if not members:
+                del self.rooms[room_id]
+                self._presence_snapshots.pop(room_id, None)
+                recent_messages.invalidate(room_id)
+                recent_events.invalidate(room_id)
+                await self.backplane.unsubscribe(room_id)
+
+        connection = subscription.connection
+        presence_info = {"user_id": connection.user_id, "username": connection.username}
+        if resumable and RESUME_GRACE_SECONDS > 0:
+            await self.backplane.defer_presence_removal(
+                room_id, subscription.member_id, presence_info, time.time() + RESUME_GRACE_SECONDS
+            )
+        elif await self.backplane.remove_presence(room_id, subscription.member_id, connection.user_id):
+            self._presence_changed(room_id, presence_info)
+        print(f"User {connection.username} disconnected from room {room_id}")
+
+    async def remove_departed(self, now: Optional[float] = None) -> int:
+        # Removes the presence of dropped connections whose grace period is over
+        departed = await self.backplane.claim_departures(now if now is not None else time.time())
+        for room_id, member_id, user_info in departed:
+            if await self.backplane.remove_presence(room_id, member_id, user_info["user_id"]):
+                self._presence_changed(room_id, user_info)
+        return len(departed)
+
+    async def _sweep_departures(self):
+        while True:
+            await asyncio.sleep(DEPARTURE_SWEEP_INTERVAL)
+            try:
+                await self.remove_departed()
+            except Exception as e:
+                print(f"Departure sweep error: {e}")
+
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-    
-    async def broadcast_to_room(self, message: dict, room_id: int):
-        if room_id in self.active_connections:
-            message_str = json.dumps(message, default=str)
-            connections_to_remove = []
-            
-            for connection in self.active_connections[room_id].copy():
-                try:
-                    await connection.send_text(message_str)
-                except:
-                    # Connection is closed, mark for removal
-                    connections_to_remove.append(connection)
-            
-            # Remove closed connections
-            for connection in connections_to_remove:
-                self.disconnect(connection)
-    
+        # message is a JSON frame, converted for clients using a binary format
+        connection = self.connections.get(websocket)
+        send_queue = connection.send_queue if connection else None
+        if send_queue and not send_queue.put(send_queue.wire_format.from_json(message)):
+            self._drop_slow_consumer(websocket)
+
+    async def broadcast_to_room(self, message: dict, room_id: int, seq_floor: Optional[SequenceFloor] = None) -> int:
+        # Serialize once, every worker with members in the room delivers the same frame.
+        # With a seq_floor the event is numbered in the room's sequence, see events.py.
+        message_str = dumps(message)
+        event_id = message.get("id") or message.get("message_id") or 0
+        return await self.backplane.publish(room_id, message.get("type", ""), message_str, event_id, seq_floor)
+
+    async def _deliver_local(self, room_id: int, kind: str, frame: str, event_id: int = 0, seq: int = 0):
+        if seq:
+            recent_events.append(room_id, seq, event_id, frame)
+        if kind == "message":
+            recent_messages.append(room_id, event_id, frame)
+        elif kind in MESSAGE_UPDATE_TYPES:
+            recent_messages.apply(room_id, kind, event_id, frame)
+            if kind == "message_deleted":
+                recent_events.forget_message(room_id, event_id, seq)
+
+        members = self.rooms.get(room_id)
+        if not members:
+            return
+
+        started = time.perf_counter()
+        slow_consumers: List[WebSocket] = []
+        # Binary formats are derived from the JSON frame at most once per event
+        derived: Dict[WireFormat, Frame] = {}
+        if len(members.shards) == 1 and not (members.lock and members.lock.locked()):
+            self._fan_out(members.shards[0], kind, frame, derived, slow_consumers)
+        else:
+            # Shards are fanned out in place, one per event loop turn. The lock keeps a later
+            # event from overtaking this one on shards it hasn't reached yet.
+            if members.lock is None:
+                members.lock = asyncio.Lock()
+            async with members.lock:
+                for index in range(len(members.shards)):
+                    self._fan_out(members.shards[index], kind, frame, derived, slow_consumers)
+                    await asyncio.sleep(0)
+        BROADCAST_FANOUT_SECONDS.observe(time.perf_counter() - started)
+        BROADCAST_RECIPIENTS.observe(len(members))
+
+        for websocket in slow_consumers:
+            self._drop_slow_consumer(websocket)
+
+    def _fan_out(
+        self,
+        shard: Set[Subscription],
+        kind: str,
+        frame: str,
+        derived: Dict[WireFormat, Frame],
+        slow_consumers: List[WebSocket]
+    ):
+        # Synchronous, the shard can't change while it is walked
+        for subscription in shard:
+            send_queue = subscription.connection.send_queue
+            if not send_queue:
+                continue
+            wire_format = send_queue.wire_format
+            if wire_format is JSON_FORMAT:
+                payload = frame
+            else:
+                payload = derived.get(wire_format)
+                if payload is None:
+                    payload = derived[wire_format] = wire_format.from_json(frame)
+            pending = subscription.pending
+            if pending is not None:
+                # Still joining, bounded like the send queue
+                if len(pending) >= send_queue.maxsize:
+                    del pending[0]
+                    DROPPED_FRAMES.inc(reason="queue_full")
+                pending.append((kind, payload))
+            elif not send_queue.put(payload, kind):
+                slow_consumers.append(subscription.connection.websocket)
+
+    def _drop_slow_consumer(self, websocket: WebSocket):
+        # Stop queueing right away, the rest of the cleanup needs the event loop
+        connection = self.connections.get(websocket)
+        if connection and connection.send_queue:
+            SLOW_CONSUMER_DISCONNECTS.inc()
+            DROPPED_FRAMES.inc(connection.send_queue.depth() + 1, reason="slow_consumer")
+            connection.send_queue.close()
+            connection.send_queue = None
+        asyncio.create_task(self._close_connection(websocket, 1013, "Slow consumer"))
+
+    async def _close_connection(self, websocket: WebSocket, code: int, reason: str):
+        await self.disconnect(websocket)
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def touch(self, websocket: WebSocket):
+        # Called for every inbound frame, pongs included
+        connection = self.connections.get(websocket)
+        if connection:
+            connection.last_seen = time.monotonic()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await self.reap_idle_connections()
+                self._send_pings()
+            except Exception as e:
+                print(f"Heartbeat error: {e}")
+
+    def _send_pings(self):
+        # One encoded ping per wire format, shared by every connection
+        frames: Dict[WireFormat, Frame] = {}
+        for websocket, connection in list(self.connections.items()):
+            send_queue = connection.send_queue
+            if not send_queue:
+                continue
+            wire_format = send_queue.wire_format
+            frame = frames.get(wire_format)
+            if frame is None:
+                frame = frames[wire_format] = wire_format.encode(PING)
+            if not send_queue.put(frame, "ping"):
+                self._drop_slow_consumer(websocket)
+
+    async def reap_idle_connections(self, timeout: float = HEARTBEAT_TIMEOUT) -> int:
+        # Closes every connection silent for longer than timeout, returns how many were reaped
+        deadline = time.monotonic() - timeout
+        idle = [
+            websocket for websocket, connection in self.connections.items()
+            if connection.last_seen < deadline
+        ]
+        if idle:
+            REAPED_CONNECTIONS.inc(len(idle))
+            await asyncio.gather(*(
+                self._close_connection(websocket, 1001, "Heartbeat timeout") for websocket in idle
+            ))
+        return len(idle)
+
+    def _presence_changed(self, room_id: int, user_info: dict):
+        # A user appeared or disappeared. Changes are only collected here, the delta reports
+        # each user's state when it is committed, so a join and leave in one window still
+        # reaches clients that got a snapshot in between.
+        self._presence_changes.setdefault(room_id, {})[user_info["user_id"]] = user_info
+        if room_id not in self._presence_flushes:
+            self._presence_flushes[room_id] = asyncio.create_task(self._delayed_presence_flush(room_id))
+
+    async def _delayed_presence_flush(self, room_id: int):
+        try:
+            await asyncio.sleep(PRESENCE_COALESCE_MS / 1000)
+        finally:
+            self._presence_flushes.pop(room_id, None)
+        await self._flush_presence(room_id)
+
+    async def _flush_presence(self, room_id: int):
+        changes = self._presence_changes.pop(room_id, None)
+        if not changes:
+            return
+
+        try:
+            # Each delta carries the users' state at its version, so applying deltas in
+            # version order converges even when several workers report the same user
+            version, present = await self.backplane.commit_presence(room_id, changes.keys())
+            delta = {
+                "type": "presence_delta",
+                "room_id": room_id,
+                "version": version,
+                "joined": [info for user_id, info in changes.items() if present[user_id]],
+                "left": [user_id for user_id in changes if not present[user_id]],
+                "timestamp": datetime.utcnow().isoformat()
+            }
+            await self.broadcast_to_room(delta, room_id)
+        except Exception as e:
+            print(f"Presence flush failed for room {room_id}: {e}")
+
+    async def get_presence_snapshot(self, room_id: int) -> str:
+        # Full presence frame sent on join and on presence_sync, shared while the version holds
+        version = await self.backplane.get_presence_version(room_id)
+        cached = self._presence_snapshots.get(room_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        version, users = await self.backplane.get_presence(room_id)
+        frame = dumps({
+            "type": "presence_snapshot",
+            "room_id": room_id,
+            "version": version,
+            "users": users,
+            "count": len(users)
+        })
+        if room_id in self.rooms:
+            self._presence_snapshots[room_id] = (version, frame)
+        return frame
+
     def get_room_connections_count(self, room_id: int) -> int:
-        return len(self.active_connections.get(room_id, set()))
-    
-    def get_active_users_in_room(self, room_id: int) -> List[dict]:
-        if room_id not in self.active_connections:
-            return []
-        
-        users = []
-        for connection in self.active_connections[room_id]:
-            user_info = self.connection_users.get(connection)
-            if user_info:
-                users.append({
-                    "user_id": user_info["user_id"],
-                    "username": user_info["username"]
-                })
+        # Connections held by this process only
+        members = self.rooms.get(room_id)
+        return len(members) if members else 0
+
+    async def get_active_users_in_room(self, room_id: int) -> List[dict]:
+        # Users connected to the room on any worker
+        _, users = await self.backplane.get_presence(room_id)
         return users
 
 # Global connection manager instance
 manager = ConnectionManager()
+
+Gauge(
+    "chat_websockets",
+    "WebSocket connections held by this process, each subscribed to one or more rooms",
+    callback=lambda: len(manager.connections)
+)
+Gauge(
+    "chat_active_connections",
+    "Room subscriptions held by this process",
+    callback=lambda: sum(len(members) for members in manager.rooms.values())
+)
+Gauge(
+    "chat_active_rooms",
+    "Rooms with subscribers in this process",
+    callback=lambda: len(manager.rooms)
+)
+# One series per room would grow with the number of rooms, only the largest get their own
+Gauge(
+    "chat_top_room_connections",
+    "Room subscriptions held by this process in its METRICS_TOP_ROOMS largest rooms",
+    ["room_id"],
+    callback=lambda: dict(heapq.nlargest(
+        METRICS_TOP_ROOMS,
+        ((room_id, len(members)) for room_id, members in manager.rooms.items()),
+        key=lambda item: item[1]
+    ))
+)
+Gauge(
+    "chat_send_queue_frames",
+    "Frames waiting in all send queues of this process",
+    callback=lambda: sum(c.send_queue.depth() for c in manager.connections.values() if c.send_queue)
+)
+Gauge(
+    "chat_send_queue_max_depth",
+    "Deepest send queue in this process",
+    callback=lambda: max((c.send_queue.depth() for c in manager.connections.values() if c.send_queue), default=0)
+)
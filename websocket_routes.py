@@ -1,151 +1,416 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from typing import Optional
-import json
-from datetime import datetime
-
-from database import get_db
-from models import User, ChatRoom, Message
+import os
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Tuple
+
+from database import async_read_session
+from models import ChatRoom, Message, UserRole
 from schemas import TokenData
-from auth import verify_websocket_token
-from websocket_manager import manager
+from auth import create_resume_token, resume_session, verify_resume_token, verify_websocket_token
+from cache import get_cached_room, get_cached_user
+from events import (
+    MAX_REACTION_LENGTH,
+    current_seq,
+    delete_message,
+    edit_message,
+    message_frames,
+    message_rows,
+    publish_event,
+    react,
+    replay
+)
+from ingestion import ingestor
+from message_cache import history_frame, recent_messages, replay_frame
+from metrics import SESSION_RESUMES
+from rate_limit import connection_rate_limiter, rate_limiter
+from retention import retained, retention_floor
+from serializers import decode_frame, dumps, negotiate_format
+from websocket_manager import RESUME_GRACE_SECONDS, Connection, manager
 
 router = APIRouter()
 
-@router.websocket("/ws/{room_id}")
-async def websocket_endpoint(
-    websocket: WebSocket,
+# Messages sent to a client when it joins a room
+JOIN_BACKLOG_SIZE = 20
+# Rooms one multiplexed connection may subscribe to
+MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "100"))
+
+async def send_rate_limited(websocket: WebSocket, retry_after: float):
+    error = {
+        "type": "error",
+        "code": "rate_limited",
+        "message": "Too many messages, slow down",
+        "retry_after": round(retry_after, 3)
+    }
+    await manager.send_personal_message(dumps(error), websocket)
+
+async def send_error(websocket: WebSocket, code: str, message: str, room_id: Optional[int] = None):
+    error = {"type": "error", "code": code, "message": message}
+    if room_id is not None:
+        error["room_id"] = room_id
+    await manager.send_personal_message(dumps(error), websocket)
+
+async def load_recent_messages(
+    db: AsyncSession,
     room_id: int,
-    token: Optional[str] = Query(None),
-    db: Session = Depends(get_db)
-):
-    # Verify JWT token
+    limit: int,
+    min_id: Optional[int] = None
+) -> List[Tuple[int, str]]:
+    # Warms the recent message cache, frames match what broadcast_to_room sends with
+    # edits and reactions applied. One query for just the columns the frame needs, after
+    # this process's buffered messages are written so none older than the seq is missing.
+    await ingestor.flush()
+    query = (
+        message_rows()
+        .where(Message.room_id == room_id)
+        .order_by(Message.id.desc())
+        .limit(limit)
+    )
+    if min_id is not None:
+        query = query.where(retained(min_id))
+    result = await db.execute(query)
+    return await message_frames(db, room_id, list(reversed(result.all())))
+
+async def handle_message_change(websocket: WebSocket, message_json: dict, user_info: dict, room_id: int):
+    # edit, delete, react and unreact frames, each naming a message_id
+    user_id = user_info["user_id"]
+    kind = message_json["type"]
+    message_id = message_json.get("message_id")
+    if not isinstance(message_id, int):
+        await send_error(websocket, "invalid", "message_id is required")
+        return
+
+    if kind == "edit":
+        content = message_json.get("content")
+        if not isinstance(content, str) or not content.strip():
+            await send_error(websocket, "invalid", "content is required")
+            return
+        found = await edit_message(room_id, message_id, user_id, content.strip())
+    elif kind == "delete":
+        found = await delete_message(room_id, message_id, user_id, user_info["role"] == UserRole.admin.value)
+    else:
+        emoji = message_json.get("emoji")
+        if not isinstance(emoji, str) or not emoji or len(emoji) > MAX_REACTION_LENGTH:
+            await send_error(websocket, "invalid", f"emoji must be 1 to {MAX_REACTION_LENGTH} characters")
+            return
+        found = await react(room_id, message_id, user_id, emoji, added=kind == "react")
+
+    if not found:
+        await send_error(websocket, "not_found", "Message not found")
+
+async def authenticate(websocket: WebSocket, db: AsyncSession, token: Optional[str]) -> Optional[dict]:
+    # The session of a valid access token, None after rejecting the connection
     try:
-        token_data: TokenData = verify_websocket_token(token)
-    except HTTPException as e:
+        token_data: TokenData = await verify_websocket_token(token)
+    except HTTPException:
         await websocket.close(code=1008, reason="Unauthorized")
-        return
-    
+        return None
+
     # Get user from database
-    user = db.query(User).filter(User.username == token_data.username).first()
+    user = await get_cached_user(db, token_data.username)
     if not user:
         await websocket.close(code=1008, reason="User not found")
+        return None
+    return resume_session(token, {
+        "user_id": user.id,
+        "username": user.username,
+        "role": user.role.value
+    })
+
+async def join_room(
+    websocket: WebSocket,
+    room: ChatRoom,
+    session: dict,
+    since_seq: Optional[int],
+    member_id: Optional[str],
+    frame_type: str
+) -> str:
+    # Subscribes the connection to the room and sends its join frames: the token to resume
+    # the subscription with, the events the client missed (or the recent history) and the
+    # room's presence. Room events arriving meanwhile are sent after them.
+    room_id = room.id
+    member_id = await manager.subscribe(websocket, room_id, member_id)
+    join_frame = {
+        "type": frame_type,
+        "room_id": room_id,
+        "resume_token": create_resume_token(session, room_id, member_id),
+        "resume_grace": RESUME_GRACE_SECONDS
+    }
+    await manager.send_personal_message(dumps(join_frame), websocket)
+
+    # The session only lives for the join, open sockets hold no database connection
+    async with async_read_session() as db:
+        # A reconnecting client gets only the events it missed
+        missed = None
+        if since_seq is not None:
+            missed = await replay(db, room_id, since_seq, retention_floor(room))
+            SESSION_RESUMES.inc(outcome="history" if missed is None else "replay")
+        if missed is not None:
+            await manager.send_personal_message(replay_frame(*missed, room_id), websocket)
+        else:
+            # Send recent messages to the newly connected user as one history frame,
+            # served from memory once the room is warm
+            seq = await current_seq(db, room_id)
+            backlog = await recent_messages.get_recent(
+                room_id,
+                JOIN_BACKLOG_SIZE,
+                lambda room_id, limit: load_recent_messages(db, room_id, limit, retention_floor(room))
+            )
+            await manager.send_personal_message(
+                history_frame(backlog, room_id, seq, gap=since_seq is not None), websocket
+            )
+
+    # Send the room's presence to the new user only, the rest of the room
+    # learns about the join from the next presence_delta
+    await manager.send_personal_message(await manager.get_presence_snapshot(room_id), websocket)
+    manager.release(websocket, room_id)
+    return member_id
+
+async def handle_frame(websocket: WebSocket, connection_key: str, message_json: dict, user_info: dict, room_id: int):
+    # A frame the client sent to one of its rooms
+    kind = message_json.get("type")
+
+    # Clients that notice a gap in presence versions ask for a fresh snapshot
+    if kind == "presence_sync":
+        retry_after = await connection_rate_limiter.hit("ws_presence_sync_connection", connection_key)
+        if retry_after:
+            await send_rate_limited(websocket, retry_after)
+        else:
+            await manager.send_personal_message(await manager.get_presence_snapshot(room_id), websocket)
         return
-    
-    # Check if room exists
-    room = db.query(ChatRoom).filter(ChatRoom.id == room_id).first()
-    if not room:
-        await websocket.close(code=1008, reason="Room not found")
+
+    # Edits, deletes and reactions count against the same limits as new messages
+    if kind in ("edit", "delete", "react", "unreact"):
+        retry_after = await rate_limiter.hit("ws_message_user", user_info["user_id"])
+        if retry_after:
+            await send_rate_limited(websocket, retry_after)
+        else:
+            try:
+                await handle_message_change(websocket, message_json, user_info, room_id)
+            except Exception:
+                await send_error(websocket, "failed", "Change could not be saved")
+        return
+
+    # Validate message content
+    if "content" not in message_json or not message_json["content"].strip():
         return
+
+    # Per user across all connections and workers, then per room
+    retry_after = (
+        await rate_limiter.hit("ws_message_user", user_info["user_id"])
+        or await rate_limiter.hit("ws_message_room", room_id)
+    )
+    if retry_after:
+        await send_rate_limited(websocket, retry_after)
+        return
+
+    # Hand the message to the write-behind pipeline, it is persisted in batches
+    try:
+        db_message = await ingestor.submit(
+            content=message_json["content"].strip(),
+            user_id=user_info["user_id"],
+            room_id=room_id
+        )
+    except Exception:
+        error = {"type": "error", "message": "Message could not be saved"}
+        await manager.send_personal_message(dumps(error), websocket)
+        return
+
+    # Prepare message for broadcast
+    broadcast_message = {
+        "type": "message",
+        "id": db_message["id"],
+        "content": db_message["content"],
+        "username": user_info["username"],
+        "user_id": user_info["user_id"],
+        "timestamp": db_message["timestamp"].isoformat(),
+        "room_id": room_id
+    }
+
+    # Broadcast message to all connected clients in the room, numbered and logged
+    await publish_event(broadcast_message, room_id, db_message["id"])
+
+@router.websocket("/ws/{room_id}")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    room_id: int,
+    token: Optional[str] = Query(None),
+    since_seq: Optional[int] = Query(None),
+    resume: Optional[str] = Query(None)
+):
+    # Reject connection floods before touching the token or the database
+    if await rate_limiter.hit("ws_connect_ip", websocket.client.host):
+        await websocket.close(code=1013, reason="Rate limited")
+        return
+    
+    # Database work gets short-lived sessions, none is held while the socket is open
+    async with async_read_session() as db:
+        # A resume token from the previous connection stands in for the access token. When
+        # it has expired or its access token was revoked, the access token passed alongside
+        # is checked as usual.
+        session = None
+        if resume:
+            try:
+                session = await verify_resume_token(db, resume, room_id)
+            except HTTPException:
+                session = None
+        if session is None:
+            session = await authenticate(websocket, db, token)
+            if session is None:
+                return
+        
+        # Check if room exists
+        room = await get_cached_room(db, room_id)
+        if not room:
+            await websocket.close(code=1008, reason="Room not found")
+            return
     
-    # Connect user to the room
     user_info = {
-        "user_id": user.id,
-        "username": user.username,
-        "role": user.role.value
+        "user_id": session["user_id"],
+        "username": session["username"],
+        "role": session["role"]
     }
     
-    await manager.connect(websocket, room_id, user_info)
+    # Clients may ask for MessagePack through the WebSocket subprotocol, JSON otherwise
+    wire_format = negotiate_format(websocket)
+    connection = await manager.accept(websocket, user_info, wire_format)
     
     try:
-        # Send recent messages to the newly connected user
-        recent_messages = (
-            db.query(Message)
-            .filter(Message.room_id == room_id)
-            .order_by(Message.timestamp.desc())
-            .limit(20)
-            .all()
-        )
-        
-        # Send messages in chronological order
-        for message in reversed(recent_messages):
-            message_data = {
-                "type": "message",
-                "id": message.id,
-                "content": message.content,
-                "username": message.user.username,
-                "user_id": message.user_id,
-                "timestamp": message.timestamp.isoformat(),
-                "room_id": message.room_id
-            }
-            await manager.send_personal_message(
-                json.dumps(message_data, default=str), 
-                websocket
-            )
-        
-        # Send current active users list
-        active_users = manager.get_active_users_in_room(room_id)
-        users_data = {
-            "type": "active_users",
-            "users": active_users,
-            "count": len(active_users)
-        }
-        await manager.broadcast_to_room(users_data, room_id)
-        
-        # Send join notification
-        join_notification = {
-            "type": "user_joined",
-            "username": user.username,
-            "message": f"{user.username} joined the room",
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast_to_room(join_notification, room_id)
+        # A resumed connection takes over its predecessor's presence if it is back in time
+        await join_room(websocket, room, session, since_seq, session.get("member_id"), "session")
         
         # Listen for messages
         while True:
             # Receive message from WebSocket
-            data = await websocket.receive_text()
-            message_json = json.loads(data)
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
+            manager.touch(websocket)
             
-            # Validate message content
-            if "content" not in message_json or not message_json["content"].strip():
+            # Excess frames are rejected before they are even decoded
+            retry_after = await connection_rate_limiter.hit("ws_frame_connection", connection.key)
+            if retry_after:
+                await send_rate_limited(websocket, retry_after)
                 continue
+            message_json = decode_frame(wire_format, data)
             
-            # Save message to database
-            db_message = Message(
-                content=message_json["content"].strip(),
-                user_id=user.id,
-                room_id=room_id
-            )
-            db.add(db_message)
-            db.commit()
-            db.refresh(db_message)
-            
-            # Prepare message for broadcast
-            broadcast_message = {
-                "type": "message",
-                "id": db_message.id,
-                "content": db_message.content,
-                "username": user.username,
-                "user_id": user.id,
-                "timestamp": db_message.timestamp.isoformat(),
-                "room_id": room_id
-            }
+            # Answer to the server's heartbeat ping, touch() already recorded it
+            if message_json.get("type") == "pong":
+                continue
             
-            # Broadcast message to all connected clients in the room
-            await manager.broadcast_to_room(broadcast_message, room_id)
+            await handle_frame(websocket, connection.key, message_json, user_info, room_id)
             
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        
-        # Send leave notification
-        leave_notification = {
-            "type": "user_left",
-            "username": user.username,
-            "message": f"{user.username} left the room",
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast_to_room(leave_notification, room_id)
-        
-        # Send updated active users list
-        active_users = manager.get_active_users_in_room(room_id)
-        users_data = {
-            "type": "active_users",
-            "users": active_users,
-            "count": len(active_users)
-        }
-        await manager.broadcast_to_room(users_data, room_id)
+    except WebSocketDisconnect as e:
+        # The departure reaches the room through the next presence_delta, after the grace
+        # period unless the client closed normally
+        await manager.disconnect(websocket, resumable=e.code != 1000)
         
     except Exception as e:
         print(f"WebSocket error: {e}")
-        manager.disconnect(websocket)
+        await manager.disconnect(websocket)
+
+async def subscribe_room(
+    websocket: WebSocket,
+    connection: Connection,
+    session: dict,
+    message_json: dict
+):
+    # subscribe frame of a multiplexed connection, with an optional since_seq and the
+    # resume token the room was last joined with
+    room_id = message_json["room_id"]
+    retry_after = await connection_rate_limiter.hit("ws_subscribe_connection", connection.key)
+    if retry_after:
+        await send_rate_limited(websocket, retry_after)
+        return
+    if room_id in connection.subscriptions:
+        await send_error(websocket, "invalid", "Already subscribed", room_id)
+        return
+    if len(connection.subscriptions) >= MAX_SUBSCRIPTIONS:
+        await send_error(websocket, "limit", f"At most {MAX_SUBSCRIPTIONS} rooms per connection", room_id)
+        return
+
+    # Only the user's own presence can be taken over
+    member_id = None
+    resume = message_json.get("resume")
+    async with async_read_session() as db:
+        room = await get_cached_room(db, room_id)
+        if room and isinstance(resume, str):
+            try:
+                resumed = await verify_resume_token(db, resume, room_id)
+                if resumed["user_id"] == session["user_id"]:
+                    member_id = resumed["member_id"]
+            except HTTPException:
+                pass
+    if not room:
+        await send_error(websocket, "not_found", "Room not found", room_id)
+        return
+
+    since_seq = message_json.get("since_seq")
+    if not isinstance(since_seq, int):
+        since_seq = None
+    await join_room(websocket, room, session, since_seq, member_id, "subscribed")
+
+@router.websocket("/ws")
+async def multiplexed_websocket_endpoint(
+    websocket: WebSocket,
+    token: Optional[str] = Query(None)
+):
+    # One connection for any number of rooms, joined with subscribe and left with
+    # unsubscribe frames. Frames about a room carry its room_id in both directions.
+    if await rate_limiter.hit("ws_connect_ip", websocket.client.host):
+        await websocket.close(code=1013, reason="Rate limited")
+        return
+
+    async with async_read_session() as db:
+        session = await authenticate(websocket, db, token)
+    if session is None:
+        return
+    user_info = {
+        "user_id": session["user_id"],
+        "username": session["username"],
+        "role": session["role"]
+    }
+
+    wire_format = negotiate_format(websocket)
+    connection = await manager.accept(websocket, user_info, wire_format)
+
+    try:
+        while True:
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
+            manager.touch(websocket)
+
+            retry_after = await connection_rate_limiter.hit("ws_frame_connection", connection.key)
+            if retry_after:
+                await send_rate_limited(websocket, retry_after)
+                continue
+            message_json = decode_frame(wire_format, data)
+
+            kind = message_json.get("type")
+            if kind == "pong":
+                continue
+            room_id = message_json.get("room_id")
+            if not isinstance(room_id, int):
+                await send_error(websocket, "invalid", "room_id is required")
+                continue
+
+            if kind == "subscribe":
+                await subscribe_room(websocket, connection, session, message_json)
+            elif kind == "unsubscribe":
+                # Leaves at once, the room sees the departure in its next presence_delta
+                if await manager.unsubscribe(websocket, room_id):
+                    await manager.send_personal_message(dumps({"type": "unsubscribed", "room_id": room_id}), websocket)
+                else:
+                    await send_error(websocket, "not_subscribed", "Not subscribed to this room", room_id)
+            elif room_id not in connection.subscriptions:
+                await send_error(websocket, "not_subscribed", "Not subscribed to this room", room_id)
+            else:
+                await handle_frame(websocket, connection.key, message_json, user_info, room_id)
+
+    except WebSocketDisconnect as e:
+        # Every subscribed room is left like a single room connection would leave it
+        await manager.disconnect(websocket, resumable=e.code != 1000)
+
+    except Exception as e:
+        print(f"WebSocket error: {e}")
+        await manager.disconnect(websocket)